@@ -20,9 +20,40 @@
 """
 
 import binascii
+import mmap
+import multiprocessing
 import struct
+import zlib
 
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+CHUNK_SIZE = 0x10000
+
+
+def _zlib_crc32(data):
+    """Compute CRC32 with zlib which, unlike binascii, releases the GIL."""
+    try:
+        return zlib.crc32(data) & 0xFFFFFFFF
+    except TypeError:  # Python 2 zlib rejects writable buffers
+        return binascii.crc32(data) & 0xFFFFFFFF
+
+
+def _crc32_map(buffers, workers=1):
+    """Compute the CRC32 of each buffer, on a thread pool if workers isn't 1.
+
+    Large buffers are hashed concurrently as zlib releases the GIL.
+    """
+    if workers == 1 or len(buffers) < 2:
+        return [binascii.crc32(data) & 0xFFFFFFFF for data in buffers]
+    if not workers or workers < 0:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(min(workers, len(buffers)))
+    try:
+        return pool.map(_zlib_crc32, buffers)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class Archive(object):
@@ -66,9 +97,15 @@ class Archive(object):
             if not condition:
                 raise Archive.Assertion(section, message)
 
-    def __init__(self):
-        """Create empty Archive."""
+    def __init__(self, defer_crc32=False):
+        """Create empty Archive.
+
+        If defer_crc32 is True, the CRC32 of new sections is left to None
+        and only computed by update_crc32(), which pack() calls.
+        """
         self._sections = []
+        self._clean = []
+        self.defer_crc32 = defer_crc32
 
     def __len__(self):
         """Return Archive section count."""
@@ -89,7 +126,8 @@ class Archive(object):
             return
         data = bytearray(data)
         self._sections[index] = Archive.Section(
-            data, len(data), binascii.crc32(data) & 0xFFFFFFFF
+            data, len(data),
+            None if self.defer_crc32 else binascii.crc32(data) & 0xFFFFFFFF
         )
 
     def __delitem__(self, index):
@@ -102,9 +140,38 @@ class Archive(object):
             self._sections.append(data)
             return
         data = bytearray(data)
-        self._sections.append(
-            Archive.Section(data, len(data), binascii.crc32(data) & 0xFFFFFFFF)
-        )
+        self._sections.append(Archive.Section(
+            data, len(data),
+            None if self.defer_crc32 else binascii.crc32(data) & 0xFFFFFFFF
+        ))
+
+    def add_sections(self, sections, workers=1):
+        """Add Archive sections, computing their CRC32 on a thread pool."""
+        for data in sections:
+            if not isinstance(data, Archive.Section):
+                data = bytearray(data)
+                data = Archive.Section(data, len(data), None)
+            self._sections.append(data)
+        if not self.defer_crc32:
+            self.update_crc32(workers)
+
+    def update_crc32(self, workers=1):
+        """Compute the CRC32 of sections whose CRC32 was deferred."""
+        pending = [
+            i for i, section in enumerate(self._sections)
+            if isinstance(section, Archive.Section) and section.crc32 is None
+        ]
+        crcs = _crc32_map([self._sections[i].data for i in pending], workers)
+        for i, crc32 in zip(pending, crcs):
+            self._sections[i] = self._sections[i]._replace(crc32=crc32)
+
+    def dirty_sections(self):
+        """Return the indices of sections modified since the Archive was
+        last unpacked, written or patched."""
+        return [
+            i for i, section in enumerate(self._sections)
+            if i >= len(self._clean) or section is not self._clean[i]
+        ]
 
     def get_section(self, index):
         """Get Archive section."""
@@ -118,42 +185,139 @@ class Archive(object):
         """Delete Archive section."""
         del self[index]
 
-    def pack(self, padding=16):
-        """Pack Archive into bytearray."""
+    def _pack_header(self):
+        """Pack Archive header and section table."""
+        self.update_crc32()
         header = bytearray(b"RSBJ")
         section_count = len(self._sections)
         header.extend(struct.pack("<I", section_count))
         section_address = 8 + 12 * section_count
 
-        data = bytearray()
-        for section in self._sections:
+        for section in self:
             header.extend(struct.pack(
                 ">III",
                 section_address, section.size, section.crc32
             ))
-            data.extend(section.data)
             section_address += section.size
 
-        archive = header + data
+        return header
+
+    def packed_size(self, padding=16):
+        """Return packed Archive size."""
+        size = 8 + sum(12 + section.size for section in self)
         if padding:
-            archive.extend(bytearray(
-                (padding - len(archive) % padding) % padding
-            ))
+            size += (padding - size % padding) % padding
+        return size
 
+    def pack(self, padding=16):
+        """Pack Archive into bytearray."""
+        archive = bytearray(self.packed_size(padding))
+        self.pack_into(archive, 0, padding)
         return archive
 
-    def unpack(self, data, ignore_errors=False):
-        """Unpack Archive from bytes."""
+    def pack_into(self, buffer, offset=0, padding=16):
+        """Pack Archive into a writable buffer at offset.
+
+        The section table and the sections are written directly into the
+        buffer (bytearray, mmap, memoryview, ...). Return the packed size.
+        """
+        start = offset
+        header = self._pack_header()
+        buffer[offset:offset+len(header)] = header
+        offset += len(header)
+        for section in self:
+            buffer[offset:offset+section.size] = section.data
+            offset += section.size
+        if padding:
+            size = (padding - (offset - start) % padding) % padding
+            buffer[offset:offset+size] = bytearray(size)
+            offset += size
+        return offset - start
+
+    def write(self, f, padding=16):
+        """Write Archive to a file object, return the written size.
+
+        The section table is written first, then each section, without
+        building the whole Archive in memory.
+        """
+        header = self._pack_header()
+        f.write(header)
+        size = len(header)
+        for section in self:
+            f.write(section.data)
+            size += section.size
+        if padding:
+            f.write(bytearray((padding - size % padding) % padding))
+            size += (padding - size % padding) % padding
+        self._clean = list(self._sections)
+        return size
+
+    def patch(self, f, offset=0):
+        """Rewrite dirty sections of an existing Archive file in place.
+
+        Only the modified section bytes and their 12-byte table entries are
+        written, sections must keep their size. Return the patched indices.
+        """
+        table = unpack_table(file_reader(f, offset))
+        Archive.Assertion.do(
+            len(table) == len(self._sections),
+            None, "section count ({}) doesn't match file ({})".format(
+                len(self._sections), len(table)
+            )
+        )
+        dirty = self.dirty_sections()
+        for i in dirty:
+            Archive.Assertion.do(
+                self._sections[i].size == table[i][1],
+                i, "size ({}) doesn't match file ({})".format(
+                    self._sections[i].size, table[i][1]
+                )
+            )
+        self.update_crc32()
+
+        for i in dirty:
+            address, size, _ = table[i]
+            section = self._sections[i]
+            f.seek(offset + address)
+            f.write(section.data)
+            f.seek(offset + 8 + 12 * i)
+            f.write(struct.pack(">III", address, size, section.crc32))
+        self._clean = list(self._sections)
+        return dirty
+
+    def unpack(self, data, ignore_errors=False, copy=True, workers=1):
+        """Unpack Archive from bytes.
+
+        If copy is False, sections data are memoryview slices of data
+        (bytes, bytearray, mmap, ...) instead of copies. The buffer must
+        then outlive the Archive and section data must be copied before
+        being modified, e.g. archive[i] = bytearray(archive[i].data).
+
+        If workers isn't 1, section CRCs are verified on a thread pool once
+        the section table has been checked (0 uses all CPUs).
+        """
         self._sections = []
-        data = bytearray(data)
+        data = bytearray(data) if copy else memoryview(data)
         fourcc = data[:4]
         if not ignore_errors:
+            Archive.Assertion.do(
+                len(data) >= 8,
+                None, "truncated header"
+            )
             Archive.Assertion.do(
                 fourcc == bytearray(b"RSBJ"),
                 None, "invalid four-character code"
             )
 
-        section_count, = struct.unpack_from("<I", data, 4)
+        section_count = 0
+        if len(data) >= 8:
+            section_count, = struct.unpack_from("<I", data, 4)
+        if not ignore_errors:
+            Archive.Assertion.do(
+                8 + 12 * section_count <= len(data),
+                None, "truncated section table"
+            )
+        section_count = min(section_count, max(len(data) - 8, 0) // 12)
         index = 8
         for i in range(section_count):
             address, size, crc32 = struct.unpack_from(">III", data, index)
@@ -165,13 +329,13 @@ class Archive(object):
                     )
                 )
                 Archive.Assertion.do(
-                    address+size < len(data),
+                    address+size <= len(data),
                     i, "size ({}) out of range {}".format(
                         size, len(data)
                     )
                 )
             section = data[address:address+size]
-            if not ignore_errors:
+            if not ignore_errors and workers == 1:
                 expected_crc32 = binascii.crc32(section) & 0xFFFFFFFF
                 Archive.Assertion.do(
                     crc32 == expected_crc32,
@@ -184,6 +348,20 @@ class Archive(object):
             ))
             index += 12
 
+        if not ignore_errors and workers != 1:
+            crcs = _crc32_map(
+                [section.data for section in self._sections], workers
+            )
+            for i, expected_crc32 in enumerate(crcs):
+                crc32 = self._sections[i].crc32
+                Archive.Assertion.do(
+                    crc32 == expected_crc32,
+                    i, "bad crc32 (0x{:08x}), 0x{:08x} expected".format(
+                        crc32, expected_crc32
+                    )
+                )
+
+        self._clean = list(self._sections)
         return self
 
 
@@ -192,28 +370,308 @@ def pack(archive):
 
 
 def pack_into(archive, buffer, offset):
-    data = archive.pack()
-    buffer[offset:offset+len(data)] = data
+    return archive.pack_into(buffer, offset)
+
+
+def unpack(data, ignore_errors=False, copy=True, workers=1):
+    return Archive().unpack(data, ignore_errors, copy, workers)
+
+
+def unpack_from(buffer, offset=0, ignore_errors=False, copy=True, workers=1):
+    data = buffer[offset:] if copy else memoryview(buffer)[offset:]
+    return Archive().unpack(data, ignore_errors, copy, workers)
 
 
-def unpack(data, ignore_errors=False):
-    return Archive().unpack(data, ignore_errors)
+def file_reader(f, offset=0):
+    """Return a read(address, size) function reading file f at offset."""
+    def read(address, size):
+        f.seek(offset + address)
+        return f.read(size)
+    return read
 
 
-def unpack_from(buffer, offset=0, ignore_errors=False):
-    data = buffer[offset:]
-    return Archive().unpack(data, ignore_errors)
+def unpack_table(read, ignore_errors=False):
+    """Unpack Archive section table using a read(offset, size) function.
+
+    Return a list of (address, size, crc32) tuples.
+    """
+    header = read(0, 8)
+    if not ignore_errors:
+        Archive.Assertion.do(
+            len(header) == 8,
+            None, "truncated header"
+        )
+        Archive.Assertion.do(
+            header[:4] == b"RSBJ",
+            None, "invalid four-character code"
+        )
+
+    section_count, = struct.unpack_from("<I", header, 4)
+    table = read(8, 12 * section_count)
+    if not ignore_errors:
+        Archive.Assertion.do(
+            len(table) == 12 * section_count,
+            None, "truncated section table"
+        )
+    return [
+        struct.unpack_from(">III", table, index)
+        for index in range(0, len(table) - len(table) % 12, 12)
+    ]
+
+
+def unpack_section(read, index, ignore_errors=False, table=None):
+    """Unpack a single Archive section using a read(offset, size) function.
+
+    Only the header, the section table and the section bytes are read,
+    which allows reading a section from an encrypted archive without
+    decrypting the rest of it (see crypto.range_reader).
+    """
+    if table is None:
+        table = unpack_table(read, ignore_errors)
+    address, size, crc32 = table[index]
+    section = bytearray(read(address, size))
+    if not ignore_errors:
+        Archive.Assertion.do(
+            len(section) == size,
+            index, "size ({}) out of range".format(size)
+        )
+        expected_crc32 = binascii.crc32(section) & 0xFFFFFFFF
+        Archive.Assertion.do(
+            crc32 == expected_crc32,
+            index, "bad crc32 (0x{:08x}), 0x{:08x} expected".format(
+                crc32, expected_crc32
+            )
+        )
+    return Archive.Section(section, len(section), crc32)
+
+
+def iter_unpack(chunks, ignore_errors=False):
+    """Unpack Archive sections from an iterable of chunks in a single pass.
+
+    Yield (index, section) tuples in address order as soon as a section's
+    data has been received, chunks after the last section aren't consumed.
+    Only the data of the current section and the ones overlapping it are
+    buffered, so chunks can come straight from crypto.decrypt_stream.
+    """
+    chunks = iter(chunks)
+    buffer = bytearray()
+    base = 0  # Stream offset of buffer[0]
+
+    def fill(end):
+        while base + len(buffer) < end:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            buffer.extend(chunk)
+        return True
+
+    fill(8)
+    if not ignore_errors:
+        Archive.Assertion.do(
+            len(buffer) >= 8,
+            None, "truncated header"
+        )
+        Archive.Assertion.do(
+            buffer[:4] == b"RSBJ",
+            None, "invalid four-character code"
+        )
+    if len(buffer) < 8:
+        return
+    section_count, = struct.unpack_from("<I", buffer, 4)
+    if not fill(8 + 12 * section_count):
+        if not ignore_errors:
+            raise Archive.Assertion(None, "truncated section table")
+        section_count = (len(buffer) - 8) // 12
+    table = [
+        struct.unpack_from(">III", buffer, 8 + 12 * i)
+        for i in range(section_count)
+    ]
+
+    order = sorted(range(section_count), key=lambda i: table[i][0])
+    for position, i in enumerate(order):
+        address, size, crc32 = table[i]
+        fill(address + size)
+        section = buffer[address-base:address-base+size]
+        if not ignore_errors:
+            Archive.Assertion.do(
+                len(section) == size,
+                i, "size ({}) out of range".format(size)
+            )
+            expected_crc32 = binascii.crc32(section) & 0xFFFFFFFF
+            Archive.Assertion.do(
+                crc32 == expected_crc32,
+                i, "bad crc32 (0x{:08x}), 0x{:08x} expected".format(
+                    crc32, expected_crc32
+                )
+            )
+        yield i, Archive.Section(section, len(section), crc32)
+
+        # Drop the data before the next section
+        if position + 1 < len(order):
+            drop = min(table[order[position+1]][0] - base, len(buffer))
+        else:
+            drop = len(buffer)
+        del buffer[:drop]
+        base += drop
+
+
+def validate(f, deep=False, offset=0):
+    """Validate an Archive file without unpacking it.
+
+    The quick level only reads the header and the section table, checking
+    sections are within the file and don't overlap. If deep is True, the
+    section CRCs are checked too, reading CHUNK_SIZE bytes at a time.
+    Return a report dict with the archive size, section count and errors.
+    """
+    errors = []
+    f.seek(0, 2)
+    size = f.tell() - offset
+    report = {"size": size, "sections": None, "errors": errors}
+
+    def error(section, message):
+        errors.append(str(Archive.Assertion(section, message)))
+
+    read = file_reader(f, offset)
+    header = read(0, 8)
+    if len(header) < 8:
+        error(None, "truncated header")
+        return report
+    if header[:4] != b"RSBJ":
+        error(None, "invalid four-character code")
+    section_count, = struct.unpack_from("<I", header, 4)
+    report["sections"] = section_count
+    table_end = 8 + 12 * section_count
+    if table_end > size:
+        error(None, "truncated section table ({} sections)".format(
+            section_count
+        ))
+        return report
+
+    table = unpack_table(read, ignore_errors=True)
+    end = table_end
+    for i in sorted(range(section_count), key=lambda i: table[i][0]):
+        address, section_size, crc32 = table[i]
+        if address < table_end:
+            error(i, "address ({}) inside section table".format(address))
+        elif address < end:
+            error(i, "address ({}) overlaps previous section".format(address))
+        if address + section_size > size:
+            error(i, "size ({}) out of range ({})".format(section_size, size))
+            continue
+        end = max(end, address + section_size)
+        if deep:
+            expected_crc32 = 0
+            for start in range(address, address + section_size, CHUNK_SIZE):
+                expected_crc32 = binascii.crc32(read(
+                    start, min(CHUNK_SIZE, address + section_size - start)
+                ), expected_crc32)
+            expected_crc32 &= 0xFFFFFFFF
+            if crc32 != expected_crc32:
+                error(i, "bad crc32 (0x{:08x}), 0x{:08x} expected".format(
+                    crc32, expected_crc32
+                ))
+    return report
+
+
+def validate_files(paths, deep=False, offset=0):
+    """Validate Archive files one at a time, yield their reports."""
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                report = validate(f, deep, offset)
+        except (IOError, OSError) as e:
+            report = {"size": None, "sections": None, "errors": [str(e)]}
+        report["path"] = path
+        report["valid"] = not report["errors"]
+        yield report
+
+
+class LazyArchive(Archive):
+    """SSBB DLS1 archive loading its sections on first access.
+
+    Only the header and the section table are parsed up front, each
+    section is read and CRC-checked the first time it is accessed. The
+    parsed section table, a list of (address, size, crc32), is kept in
+    the table attribute.
+    """
+
+    def __init__(self, read, ignore_errors=False):
+        """Create Archive from a read(offset, size) function."""
+        Archive.__init__(self)
+        self._read = read
+        self._ignore_errors = ignore_errors
+        self._mmap = None
+        self.table = unpack_table(read, ignore_errors)
+        # Unloaded sections are stored as their section table entry
+        self._sections = list(self.table)
+        self._clean = list(self._sections)
+
+    @classmethod
+    def open(cls, path, offset=0, ignore_errors=False):
+        """Open Archive file using mmap."""
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            archive = cls(
+                lambda address, size: data[offset+address:offset+address+size],
+                ignore_errors
+            )
+        except Exception:
+            data.close()
+            raise
+        archive._mmap = data
+        return archive
+
+    def close(self):
+        """Close the underlying mmap, unloaded sections become unreadable."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _load(self, index):
+        """Load and return Archive section."""
+        section = entry = self._sections[index]
+        if not isinstance(section, Archive.Section):
+            if index < 0:
+                index += len(self._sections)
+            section = unpack_section(
+                self._read, index, self._ignore_errors, self._sections
+            )
+            if index < len(self._clean) and self._clean[index] is entry:
+                self._clean[index] = section
+            self._sections[index] = section
+        return section
+
+    def __iter__(self):
+        """Iterate over Archive sections."""
+        return (self._load(i) for i in range(len(self._sections)))
+
+    def __getitem__(self, index):
+        """Get Archive section."""
+        if isinstance(index, slice):
+            return [self._load(i) for i in range(*index.indices(len(self)))]
+        return self._load(index)
 
 
 if __name__ == "__main__":
     import argparse
+    import functools
     import os
+    import sys
+
+    import batch
 
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-u", "--unpack",
-                       type=str, metavar="FILE",
-                       help="unpack files from SSBB archive file")
+                       type=str, nargs="+", metavar="FILE",
+                       help="unpack files from SSBB archive files")
+    group.add_argument("-v", "--verify",
+                       type=str, nargs="+", metavar="FILE",
+                       help="check SSBB archive files")
+    group.add_argument("-s", "--scan",
+                       type=str, nargs="+", metavar="FILE",
+                       help="validate SSBB archive files headers")
     group.add_argument("-p", "--pack",
                        type=str, nargs="+", metavar="FILE",
                        help="pack files into SSBB archive file")
@@ -226,24 +684,74 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--dest",
                         type=str,
                         help="destination file(s) name")
+    parser.add_argument("-j", "--jobs",
+                        type=int, default=1,
+                        help="CRC32 threads (0 to use all CPUs)")
+    parser.add_argument("-P", "--processes",
+                        type=int, default=1,
+                        help="files processed in parallel (0 to use all CPUs)")
+    parser.add_argument("--pattern",
+                        type=str, default="*",
+                        help="files to process in directories")
+    parser.add_argument("--deep",
+                        action="store_true",
+                        help="also check section CRCs when scanning")
+    parser.add_argument("-r", "--report",
+                        type=str,
+                        help="scan report file (JSON lines, default stdout)")
 
     args = parser.parse_args()
-    if not args.unpack and not args.pack:
-        parser.print_help()
+    summary = None
     if args.unpack:
-        archive = unpack_from(
-            open(args.unpack, "rb").read(), args.offset, args.ignore
+        paths = batch.expand(args.unpack, args.pattern)
+        if args.dest and len(paths) > 1:
+            parser.error("--dest requires a single file to unpack")
+        summary = batch.run(
+            functools.partial(
+                batch.unpack_path, offset=args.offset,
+                ignore_errors=args.ignore, workers=args.jobs, dest=args.dest
+            ),
+            paths, args.processes
         )
-        name, ext = os.path.splitext(args.dest if args.dest else args.unpack)
-        for i, section in enumerate(archive):
-            with open("{}.{:03d}{}".format(name, i, ext), "wb") as f:
-                f.write(section.data)
+    if args.verify:
+        summary = batch.run(
+            functools.partial(batch.verify_path, offset=args.offset),
+            batch.expand(args.verify, args.pattern), args.processes
+        )
+    if args.scan:
+        import json
+        import time
+
+        start = time.time()
+        count = invalid = 0
+        out = open(args.report, "w") if args.report else sys.stdout
+        try:
+            for report in validate_files(
+                batch.expand(args.scan, args.pattern), args.deep, args.offset
+            ):
+                out.write(json.dumps(report, sort_keys=True) + "\n")
+                count += 1
+                invalid += not report["valid"]
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write("{} files ({} invalid) scanned in {:.2f}s\n".format(
+            count, invalid, time.time() - start
+        ))
+        if invalid:
+            sys.exit(1)
     if args.pack:
+        paths = batch.expand(args.pack, args.pattern)
         archive = Archive()
-        for path in args.pack:
-            archive.add_section(open(path, "rb").read())
-        name = args.dest if args.dest else "{}.rsbj".format(args.pack[0])
+        archive.add_sections(
+            (open(path, "rb").read() for path in paths), args.jobs
+        )
+        name = args.dest if args.dest else "{}.rsbj".format(paths[0])
         flags = "rb+" if os.path.exists(name) else "wb"
         with open(name, flags) as f:
             f.seek(args.offset)
-            f.write(archive.pack())
+            archive.write(f)
+    if summary is not None:
+        batch.report(summary)
+        if summary.failures:
+            sys.exit(1)
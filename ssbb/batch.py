@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB batch module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from archive import CHUNK_SIZE, iter_unpack, unpack_from
+
+_replace = getattr(os, "replace", os.rename)
+
+Summary = namedtuple("BatchSummary", ["files", "size", "failures", "elapsed"])
+
+
+def expand(paths, pattern="*"):
+    """Expand directories and glob patterns into a list of files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, pattern))
+        else:
+            matches = glob.glob(path) or [path]  # Missing files must fail
+        files.extend(sorted(p for p in matches if not os.path.isdir(p)))
+    return files
+
+
+@contextmanager
+def atomic_open(path, mode="wb"):
+    """Open a temporary file which replaces path once written.
+
+    The file is created with mode 0o666, the kernel applying the umask as
+    for a file created by open().
+    """
+    tmp = os.path.join(
+        os.path.dirname(path) or ".", ".{}.tmp".format(uuid.uuid4().hex)
+    )
+    fd = os.open(
+        tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+        0o666
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        _replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def decrypt_path(path, name="WIFI", workers=1, min_size=0):
+    """Decrypt path into its .dec file, return the processed size."""
+    from crypto import KEY_IV_MAP, decrypt_file
+
+    key, iv = KEY_IV_MAP[name]
+    size = os.path.getsize(path)
+    if size < min_size:
+        workers = 1
+    fname, fext = os.path.splitext(path)
+    with open(path, "rb") as src, atomic_open(fname + ".dec" + fext) as dst:
+        decrypt_file(src, dst, key, iv, workers=workers)
+    return size
+
+
+def encrypt_path(path, name="WIFI"):
+    """Encrypt path into its .enc file, return the processed size."""
+    from crypto import KEY_IV_MAP, encrypt_file
+
+    key, iv = KEY_IV_MAP[name]
+    fname, fext = os.path.splitext(path)
+    with open(path, "rb") as src, atomic_open(fname + ".enc" + fext) as dst:
+        encrypt_file(src, dst, key, iv)
+    return os.path.getsize(path)
+
+
+def unpack_path(path, offset=0, ignore_errors=False, workers=1, dest=None):
+    """Unpack path sections into numbered files, return the processed size.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    archive = unpack_from(data, offset, ignore_errors, False, workers)
+    name, ext = os.path.splitext(dest if dest else path)
+    for i, section in enumerate(archive):
+        with atomic_open("{}.{:03d}{}".format(name, i, ext)) as f:
+            f.write(section.data)
+    return len(data)
+
+
+def verify_path(path, offset=0):
+    """Check path header and section CRCs, return the processed size."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for _ in iter_unpack(iter(lambda: f.read(CHUNK_SIZE), b"")):
+            pass
+    return os.path.getsize(path) - offset
+
+
+def _call(task):
+    func, path = task
+    try:
+        return path, func(path), None
+    except Exception as e:
+        return path, 0, "{}: {}".format(type(e).__name__, e)
+
+
+def run(func, paths, workers=1):
+    """Call func(path) for each path, on a process pool if workers isn't 1.
+
+    func must be picklable and return the processed size. Failures don't
+    stop the batch, they are returned in the summary as (path, error).
+    """
+    start = time.time()
+    size = 0
+    failures = []
+    tasks = [(func, path) for path in paths]
+    pool = None
+    if workers == 1:
+        results = (_call(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(workers if workers > 0 else None)
+        results = pool.imap_unordered(_call, tasks)
+    try:
+        for path, processed, error in results:
+            if error:
+                failures.append((path, error))
+            else:
+                size += processed
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return Summary(len(tasks), size, failures, time.time() - start)
+
+
+def report(summary, out=sys.stderr):
+    """Print batch failures and throughput."""
+    for path, error in summary.failures:
+        out.write("{}: {}\n".format(path, error))
+    elapsed = summary.elapsed or 1e-9
+    out.write(
+        "{} files ({} failed), {:.2f} MB in {:.2f}s: "
+        "{:.1f} files/s, {:.2f} MB/s\n".format(
+            summary.files, len(summary.failures), summary.size / 1e6,
+            summary.elapsed, summary.files / elapsed,
+            summary.size / 1e6 / elapsed
+        )
+    )
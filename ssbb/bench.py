@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB benchmark module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import platform
+import random
+import sys
+import timeit
+
+from archive import Archive
+from crypto import KEY_IV_MAP, decrypt, encrypt
+from dls1 import Setting
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+# (section count, section size) of the synthetic archives
+ARCHIVES = [(1, 0x60), (16, 0x1000), (64, 0x4000), (4, 0x40000)]
+# Payload sizes of the crypto benchmarks
+PAYLOADS = [0x1000, 0x10000, 0x100000]
+# Setting corpus size
+SETTINGS = 1000
+
+
+def random_bytes(rng, size):
+    """Return size pseudo-random bytes."""
+    return bytearray(rng.getrandbits(8) for _ in range(size))
+
+
+def synthetic_archive(count, size, seed=0):
+    """Return an Archive of count random sections of size bytes."""
+    rng = random.Random(seed)
+    block = random_bytes(rng, size + 0x100)
+    archive = Archive()
+    for i in range(count):
+        start = rng.randrange(0x100)
+        archive.add_section(block[start:start+size])
+    return archive
+
+
+def synthetic_settings(count, seed=0):
+    """Return a list of count random Settings."""
+    rng = random.Random(seed)
+    settings = []
+    for i in range(count):
+        s = Setting()
+        s.contribute = rng.randrange(8)
+        s.is_infinity_contribute = rng.randrange(2)
+        s.collection_lifetime = rng.randrange(0x100)
+        s.unknown_0x03 = 0x03
+        year = rng.randrange(2008, 2020)
+        s.contribute_start = Setting.Date(year, rng.randrange(1, 13), 1)
+        s.contribute_end = Setting.Date(year + 1, rng.randrange(1, 13), 1)
+        s.watch_start = s.deliv_start = s.contribute_start
+        s.watch_end = s.deliv_end = Setting.Date(year + 5, 12, 31)
+        s.enable_upload_character = rng.getrandbits(64)
+        s.enable_upload_stage = rng.getrandbits(64)
+        s.spectator_misc = random_bytes(rng, 0x3F)
+        settings.append(s)
+    return settings
+
+
+def measure(func, size, number=None, repeat=3):
+    """Time func() and return a result dict.
+
+    size is the number of bytes processed by a call. If tracemalloc is
+    available, a separate call is traced for its peak memory and the number
+    of memory blocks allocated for its result.
+    """
+    if number is None:
+        if hasattr(timeit.Timer, "autorange"):
+            number, _ = timeit.Timer(func).autorange()
+        else:
+            number = 10
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    result = {
+        "number": number,
+        "seconds": best,
+        "bytes": size,
+        "mb_per_s": size / best / 1e6 if best else None,
+        "allocations": None,
+        "peak_bytes": None,
+    }
+    if tracemalloc is not None:
+        tracemalloc.start()
+        # The result is kept alive while taking the snapshot
+        snapshot = (func(), tracemalloc.take_snapshot())[1]
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["allocations"] = sum(
+            stat.count for stat in snapshot.statistics("filename")
+        )
+        result["peak_bytes"] = peak
+    return result
+
+
+def _crypto_cases():
+    key, iv = KEY_IV_MAP["WIFI"]
+    for size in PAYLOADS:
+        data = random_bytes(random.Random(size), size)
+        encrypted = encrypt(data, key, iv)
+        yield "crypto.encrypt/{}".format(size), size, \
+            lambda data=data: encrypt(data, key, iv)
+        yield "crypto.decrypt/{}".format(size), size, \
+            lambda data=encrypted: decrypt(data, key, iv)
+
+
+def _archive_cases():
+    for count, size in ARCHIVES:
+        archive = synthetic_archive(count, size)
+        data = archive.pack()
+        sections = [section.data for section in archive]
+        name = "{}x{}".format(count, size)
+
+        def pack_crc32(sections=sections):
+            a = Archive(defer_crc32=True)
+            for section in sections:
+                a.add_section(section)
+            return a.pack()
+
+        yield "archive.pack/" + name, len(data), archive.pack
+        yield "archive.pack+crc32/" + name, len(data), pack_crc32
+        yield "archive.unpack/" + name, len(data), \
+            lambda data=data: Archive().unpack(data)
+        yield "archive.unpack-crc32/" + name, len(data), \
+            lambda data=data: Archive().unpack(data, ignore_errors=True)
+
+
+def _setting_cases():
+    settings = synthetic_settings(SETTINGS)
+    packed = [s.pack() for s in settings]
+    size = sum(len(data) for data in packed)
+
+    def pack():
+        for s in settings:
+            s.pack()
+
+    def unpack():
+        for data in packed:
+            Setting().unpack(data)
+
+    yield "setting.pack/{}".format(SETTINGS), size, pack
+    yield "setting.unpack/{}".format(SETTINGS), size, unpack
+
+
+def run(select=None, number=None, repeat=3, out=sys.stderr):
+    """Run benchmarks whose name contains select, return the results."""
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": {},
+    }
+    for cases in (_crypto_cases, _archive_cases, _setting_cases):
+        for name, size, func in cases():
+            if select and select not in name:
+                continue
+            result = measure(func, size, number, repeat)
+            results["benchmarks"][name] = result
+            if out is not None:
+                out.write("{:<36} {:>12.2f} us {:>10.2f} MB/s\n".format(
+                    name, result["seconds"] * 1e6, result["mb_per_s"] or 0
+                ))
+    return results
+
+
+def compare(old, new, out=sys.stdout):
+    """Print the time ratio of benchmarks found in both results."""
+    for name in sorted(new["benchmarks"]):
+        if name not in old["benchmarks"]:
+            continue
+        before = old["benchmarks"][name]["seconds"]
+        after = new["benchmarks"][name]["seconds"]
+        out.write("{:<36} {:>8.2f}x{}\n".format(
+            name, before / after if after else 0,
+            " (slower)" if after > before * 1.05 else ""
+        ))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output",
+                        type=str,
+                        help="save results as JSON")
+    parser.add_argument("-c", "--compare",
+                        type=str, metavar="JSON",
+                        help="compare with previously saved results")
+    parser.add_argument("-k", "--select",
+                        type=str,
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("-n", "--number",
+                        type=int,
+                        help="calls per timing (automatic by default)")
+    parser.add_argument("-r", "--repeat",
+                        type=int, default=3,
+                        help="timings per benchmark, the best is kept")
+
+    args = parser.parse_args()
+    results = run(args.select, args.number, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), results)
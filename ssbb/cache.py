@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB payload cache module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict, namedtuple
+
+from archive import Archive
+from batch import atomic_open
+from crypto import KEY_IV_MAP, encrypt
+from dls1 import Setting
+
+Stats = namedtuple("CacheStats", [
+    "hits", "spill_hits", "misses", "evictions", "count", "size"
+])
+
+
+def content_key(sources, name="WIFI", padding=16):
+    """Return the cache key of the payload made of sources.
+
+    Sources are Setting objects, Archive sections or bytes-like objects.
+    Settings are hashed from their fields, so neither their CRC32 nor the
+    archive is computed.
+    """
+    h = hashlib.sha256()
+    h.update("{}:{}".format(name, padding).encode("ascii"))
+    for source in sources:
+        if isinstance(source, Setting):
+            data = source._pack_fields()
+        elif isinstance(source, Archive.Section):
+            data = source.data
+        else:
+            data = source
+        h.update("{}:".format(len(data)).encode("ascii"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def build(sources, name="WIFI", padding=16):
+    """Pack sources into an Archive and encrypt it with the name key."""
+    archive = Archive()
+    for source in sources:
+        if isinstance(source, Setting):
+            source = source.pack()
+        archive.add_section(source)
+    key, iv = KEY_IV_MAP[name]
+    return encrypt(archive.pack(padding), key, iv)
+
+
+class PayloadCache(object):
+    """Byte-bounded LRU cache of packed and encrypted payloads.
+
+    Payloads are keyed by content_key(), so identical settings or sections
+    share the same entry whatever object holds them. Evicted payloads are
+    written to the spill directory, if any, and read back on a later miss
+    instead of being rebuilt.
+    """
+
+    def __init__(self, max_size=0x4000000, spill=None, padding=16):
+        self.max_size = max_size
+        self.spill = spill
+        self.padding = padding
+        self.size = 0
+        self.hits = self.spill_hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if spill and not os.path.isdir(spill):
+            os.makedirs(spill)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill, key)
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            key, payload = self._entries.popitem(last=False)
+            self.size -= len(payload)
+            self.evictions += 1
+            if self.spill:
+                path = self._spill_path(key)
+                if not os.path.exists(path):
+                    with atomic_open(path) as f:
+                        f.write(payload)
+
+    def put(self, key, payload):
+        """Cache payload under key, evicting the least recently used."""
+        payload = bytes(payload)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = payload
+            self.size += len(payload)
+            self._evict()
+
+    def lookup(self, key):
+        """Return the payload cached under key or None."""
+        with self._lock:
+            payload = self._entries.pop(key, None)
+            if payload is not None:
+                self._entries[key] = payload  # Most recently used
+                self.hits += 1
+                return payload
+        if self.spill:
+            try:
+                with open(self._spill_path(key), "rb") as f:
+                    payload = f.read()
+            except IOError:
+                return None
+            with self._lock:
+                self.spill_hits += 1
+            self.put(key, payload)
+            return payload
+        return None
+
+    def get(self, sources, name="WIFI"):
+        """Return the encrypted payload of sources, building it on a miss.
+
+        See content_key() and build() for the supported sources.
+        """
+        sources = list(sources)
+        key = content_key(sources, name, self.padding)
+        payload = self.lookup(key)
+        if payload is None:
+            with self._lock:
+                self.misses += 1
+            payload = build(sources, name, self.padding)
+            self.put(key, payload)
+        return payload
+
+    def clear(self):
+        """Drop in-memory entries and reset statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.spill_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return the cache statistics."""
+        with self._lock:
+            return Stats(
+                self.hits, self.spill_hits, self.misses, self.evictions,
+                len(self._entries), self.size
+            )
@@ -19,21 +19,35 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import binascii
+import multiprocessing
+import struct
+
+from multiprocessing.pool import ThreadPool
+
 from Crypto.Cipher import AES
 
-WIFI_KEY = "9265471A9CBF3D568A13D3C481532C18".decode("hex")
-WIFI_IV = "4E0341DEE6BBAA416419B3EAE8F53BD9".decode("hex")
+WIFI_KEY = binascii.unhexlify("9265471A9CBF3D568A13D3C481532C18")
+WIFI_IV = binascii.unhexlify("4E0341DEE6BBAA416419B3EAE8F53BD9")
 
-SD_KEY = "AB01B9D8E1622B08AFBAD84DBFC2A55D".decode("hex")
-SD_IV = "4E0341DEE6BBAA416419B3EAE8F53BD9".decode("hex")
+SD_KEY = binascii.unhexlify("AB01B9D8E1622B08AFBAD84DBFC2A55D")
+SD_IV = binascii.unhexlify("4E0341DEE6BBAA416419B3EAE8F53BD9")
 
 KEY_IV_MAP = {
     "WIFI": (WIFI_KEY, WIFI_IV),
     "SD": (SD_KEY, SD_IV)
 }
 
+CHUNK_SIZE = 0x10000
+PARALLEL_MIN_SIZE = 0x100000
+
+_BLOCK = struct.Struct(">QQ")
+_IV_PREIMAGES = {}
 
-def decrypt(data, key, iv):
+
+def decrypt(data, key, iv, workers=1, min_size=PARALLEL_MIN_SIZE):
+    if workers != 1 and len(data) >= min_size:
+        return decrypt_parallel(data, key, iv, workers)
     cipher = AES.new(key, AES.MODE_CBC, iv)
     return cipher.decrypt(data)
 
@@ -43,33 +57,264 @@ def encrypt(data, key, iv):
     return cipher.encrypt(data)
 
 
+def _iv_preimage(key, iv):
+    """Return the block which encrypts to iv, it's used to restart a CBC
+    chain from iv without creating a new cipher."""
+    try:
+        return _IV_PREIMAGES[key, iv]
+    except KeyError:
+        preimage = AES.new(key, AES.MODE_ECB).decrypt(iv)
+        _IV_PREIMAGES[key, iv] = preimage
+        return preimage
+
+
+def encrypt_many(buffers, name="WIFI", output=None):
+    """Encrypt each buffer on its own using the KEY_IV_MAP name key.
+
+    A single cipher is used for the whole batch: between two buffers, a
+    block encrypting to the IV is fed to restart the CBC chain. If output
+    is a writable buffer, results are written contiguously into it and
+    memoryviews of output are returned.
+    """
+    key, iv = KEY_IV_MAP[name]
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    preimage = _BLOCK.unpack(_iv_preimage(key, iv))
+    view = None if output is None else memoryview(output)
+    offset = 0
+    chain = None
+    results = []
+    for data in buffers:
+        if chain is not None:
+            high, low = _BLOCK.unpack(chain)
+            cipher.encrypt(_BLOCK.pack(high ^ preimage[0], low ^ preimage[1]))
+            chain = None
+        if view is None:
+            result = cipher.encrypt(data)
+        else:
+            result = view[offset:offset+len(data)]
+            cipher.encrypt(data, output=result)
+            offset += len(data)
+        if len(result):
+            chain = result[-AES.block_size:]
+            if view is not None:
+                chain = chain.tobytes()
+        results.append(result)
+    return results
+
+
+def decrypt_many(buffers, name="WIFI", output=None):
+    """Decrypt each buffer on its own using the KEY_IV_MAP name key.
+
+    A single cipher is used for the whole batch: between two buffers, the
+    IV is fed as a ciphertext block to restart the CBC chain. If output
+    is a writable buffer, results are written contiguously into it and
+    memoryviews of output are returned.
+    """
+    key, iv = KEY_IV_MAP[name]
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    view = None if output is None else memoryview(output)
+    offset = 0
+    restart = False
+    results = []
+    for data in buffers:
+        if restart:
+            cipher.decrypt(iv)
+        if view is None:
+            result = cipher.decrypt(data)
+        else:
+            result = view[offset:offset+len(data)]
+            cipher.decrypt(data, output=result)
+            offset += len(data)
+        restart = restart or len(result) != 0
+        results.append(result)
+    return results
+
+
+def _decrypt_ranges(pool, data, key, iv, workers):
+    """Decrypt data split into block-aligned ranges on a pool.
+
+    CBC decryption of a block only needs the previous ciphertext block,
+    so each range uses the last block of the preceding one as its IV.
+    """
+    view = memoryview(data)
+    blocks = -(-len(data) // AES.block_size)
+    step = max(-(-blocks // workers), 1) * AES.block_size  # Empty data
+
+    def decrypt_range(start):
+        prev = iv if not start else view[start-AES.block_size:start].tobytes()
+        cipher = AES.new(key, AES.MODE_CBC, prev)
+        return cipher.decrypt(view[start:start+step].tobytes())
+
+    return pool.map(decrypt_range, range(0, len(data), step))
+
+
+def decrypt_parallel(data, key, iv, workers=None):
+    """Decrypt data using several threads, the output matches decrypt()."""
+    if not workers or workers < 0:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        return b"".join(_decrypt_ranges(pool, data, key, iv, workers))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def decrypt_range(f, offset, size, key, iv):
+    """Decrypt size bytes at offset from an encrypted file or buffer.
+
+    Only the blocks covering the range and the ciphertext block preceding
+    them are read, f can be a seekable file object or a buffer (e.g. mmap).
+    """
+    first = offset - offset % AES.block_size
+    start = max(first - AES.block_size, 0)
+    end = offset + size
+    end += -end % AES.block_size
+    if hasattr(f, "read"):
+        f.seek(start)
+        data = f.read(end - start)
+    else:
+        data = f[start:end]
+    if first:
+        iv, data = data[:AES.block_size], data[AES.block_size:]
+        if len(iv) != AES.block_size:
+            return b""
+    data = data[:len(data) - len(data) % AES.block_size]
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    offset %= AES.block_size
+    return cipher.decrypt(data)[offset:offset+size]
+
+
+def range_reader(f, key, iv):
+    """Return a read(offset, size) function decrypting f on demand."""
+    return lambda offset, size: decrypt_range(f, offset, size, key, iv)
+
+
+def _iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yield block-aligned chunks from a file-like object or an iterable.
+
+    Unaligned trailing data is yielded as is so the cipher can reject it.
+    """
+    if hasattr(source, "read"):
+        source = iter(lambda read=source.read: read(chunk_size), b"")
+    pending = b""
+    for chunk in source:
+        if pending:
+            chunk = pending + chunk
+        size = len(chunk) - len(chunk) % AES.block_size
+        pending = chunk[size:]
+        if size:
+            yield chunk[:size]
+    if pending:
+        yield pending
+
+
+def decrypt_stream(source, key, iv, chunk_size=CHUNK_SIZE, workers=1):
+    """Decrypt a file-like object or an iterable chunk by chunk.
+
+    The CBC chaining state is carried across chunks, so joining the
+    yielded chunks gives the same result as decrypt(). When workers isn't
+    1, chunk_size * workers bytes are read at once and decrypted in
+    parallel.
+    """
+    if workers == 1:
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        for chunk in _iter_chunks(source, chunk_size):
+            yield cipher.decrypt(chunk)
+        return
+
+    if not workers or workers < 0:
+        workers = multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        for chunk in _iter_chunks(source, chunk_size * workers):
+            for data in _decrypt_ranges(pool, chunk, key, iv, workers):
+                yield data
+            iv = bytes(chunk[-AES.block_size:])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def encrypt_stream(source, key, iv, chunk_size=CHUNK_SIZE):
+    """Encrypt a file-like object or an iterable chunk by chunk.
+
+    The CBC chaining state is carried across chunks, so joining the
+    yielded chunks gives the same result as encrypt().
+    """
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    for chunk in _iter_chunks(source, chunk_size):
+        yield cipher.encrypt(chunk)
+
+
+def decrypt_file(src, dst, key, iv, chunk_size=CHUNK_SIZE, workers=1):
+    """Decrypt src file-like object into dst using bounded memory."""
+    for chunk in decrypt_stream(src, key, iv, chunk_size, workers):
+        dst.write(chunk)
+
+
+def encrypt_file(src, dst, key, iv, chunk_size=CHUNK_SIZE):
+    """Encrypt src file-like object into dst using bounded memory."""
+    for chunk in encrypt_stream(src, key, iv, chunk_size):
+        dst.write(chunk)
+
+
 if __name__ == "__main__":
     import argparse
+    import functools
     import os
+    import sys
+
+    import batch
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--decrypt",
                         type=str, nargs="+",
-                        help="decrypt SSBB DLS1 files")
+                        help="decrypt SSBB DLS1 files, directories or globs")
     parser.add_argument("-e", "--encrypt",
                         type=str, nargs="+",
-                        help="encrypt SSBB DLS1 files")
+                        help="encrypt SSBB DLS1 files, directories or globs")
     parser.add_argument("-s", "--sd",
                         action="store_true",
                         help="use SD key for encryption/decryption")
+    parser.add_argument("-j", "--jobs",
+                        type=int, default=1,
+                        help="decryption threads (0 to use all CPUs)")
+    parser.add_argument("--min-size",
+                        type=int, default=PARALLEL_MIN_SIZE,
+                        help="minimum file size for parallel decryption")
+    parser.add_argument("-P", "--processes",
+                        type=int, default=1,
+                        help="files processed in parallel (0 to use all CPUs)")
+    parser.add_argument("--pattern",
+                        type=str, default="*",
+                        help="files to process in directories")
 
     args = parser.parse_args()
-    if args.sd:
-        key, iv = KEY_IV_MAP["SD"]
-    else:
-        key, iv = KEY_IV_MAP["WIFI"]
+    name = "SD" if args.sd else "WIFI"
+    summaries = []
     if args.decrypt:
-        for path in args.decrypt:
-            fname, fext = os.path.splitext(path)
-            with open(fname + ".dec" + fext, "wb") as f:
-                f.write(decrypt(open(path, "rb").read(), key, iv))
+        paths = [
+            path for path in batch.expand(args.decrypt, args.pattern)
+            if not path.endswith(".dec" + os.path.splitext(path)[1])
+        ]
+        summaries.append(batch.run(
+            functools.partial(
+                batch.decrypt_path, name=name,
+                workers=args.jobs, min_size=args.min_size
+            ),
+            paths, args.processes
+        ))
     if args.encrypt:
-        for path in args.encrypt:
-            fname, fext = os.path.splitext(path)
-            with open(fname + ".enc" + fext, "wb") as f:
-                f.write(encrypt(open(path, "rb").read(), key, iv))
+        paths = [
+            path for path in batch.expand(args.encrypt, args.pattern)
+            if not path.endswith(".enc" + os.path.splitext(path)[1])
+        ]
+        summaries.append(batch.run(
+            functools.partial(batch.encrypt_path, name=name),
+            paths, args.processes
+        ))
+    for summary in summaries:
+        batch.report(summary)
+    if any(summary.failures for summary in summaries):
+        sys.exit(1)
@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB archive delta module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii
+import struct
+
+from archive import Archive, file_reader, unpack_table
+
+
+class Delta(object):
+    """SSBB archive delta format.
+
+    A delta turns an archive (the base) into a new archive, in place.
+
+    "RSBD" FourCC
+    Base header and section table CRC32
+    Section count
+    Archive size
+    --- Repeat for each section of the new archive
+    Section address
+    Section size
+    Section CRC32
+    Operation (KEEP, COPY or DATA)
+    Source (base address for COPY, offset in the data for DATA)
+    ---
+    DATA sections
+    """
+
+    KEEP = 0  # Same section at the same address in the base
+    COPY = 1  # Same section at another address in the base
+    DATA = 2  # New section data
+
+    HEADER = struct.Struct(">4sIII")
+    ENTRY = struct.Struct(">IIIBI")
+    TABLE_ENTRY = struct.Struct(">III")
+
+
+def _packed_table(archive, padding):
+    """Return the header, section table and size of a packed Archive."""
+    header = archive._pack_header()
+    table = unpack_table(lambda offset, size: header[offset:offset+size])
+    return header, table, archive.packed_size(padding)
+
+
+def _diff(base_header, base_table, new, padding):
+    header, table, size = _packed_table(new, padding)
+    base_crc32 = binascii.crc32(base_header) & 0xFFFFFFFF
+    base_sections = {}
+    for address, section_size, crc32 in base_table:
+        base_sections.setdefault((crc32, section_size), address)
+
+    delta = bytearray(Delta.HEADER.pack(b"RSBD", base_crc32, len(table), size))
+    data = bytearray()
+    for i, (address, section_size, crc32) in enumerate(table):
+        source = base_sections.get((crc32, section_size))
+        if source is None:
+            operation, source = Delta.DATA, len(data)
+            data.extend(new[i].data)
+        elif source == address:
+            operation = Delta.KEEP
+        else:
+            operation = Delta.COPY
+        delta.extend(Delta.ENTRY.pack(
+            address, section_size, crc32, operation, source
+        ))
+    delta.extend(data)
+    return delta
+
+
+def diff(base, new, padding=16):
+    """Return the delta turning packed base Archive into new Archive."""
+    base_header, base_table, _ = _packed_table(base, padding)
+    return _diff(base_header, base_table, new, padding)
+
+
+def diff_file(f, new, padding=16):
+    """Return the delta turning base Archive file f into new Archive."""
+    read = file_reader(f)
+    base_table = unpack_table(read)
+    base_header = read(0, 8 + 12 * len(base_table))
+    return _diff(base_header, base_table, new, padding)
+
+
+def apply(f, delta):
+    """Apply a delta to the base Archive file f in place.
+
+    Only the sections which aren't kept and the modified header and table
+    entries are written. The CRC of every section, kept ones included, is
+    checked before writing, so a corrupted base is refused untouched, and
+    every section is read back afterwards. Return the indices of written
+    sections.
+    """
+    delta = memoryview(delta)
+    fourcc, base_crc32, section_count, size = Delta.HEADER.unpack_from(delta)
+    Archive.Assertion.do(
+        fourcc == b"RSBD",
+        None, "invalid delta four-character code"
+    )
+    read = file_reader(f)
+    base_table = unpack_table(read)
+    base_header = read(0, 8 + 12 * len(base_table))
+    Archive.Assertion.do(
+        binascii.crc32(base_header) & 0xFFFFFFFF == base_crc32,
+        None, "delta doesn't match the archive"
+    )
+
+    entries = [
+        Delta.ENTRY.unpack_from(
+            delta, Delta.HEADER.size + Delta.ENTRY.size * i
+        )
+        for i in range(section_count)
+    ]
+    data_offset = Delta.HEADER.size + Delta.ENTRY.size * section_count
+
+    # Gather sections before writing, COPY sources may get overwritten
+    sections = {}
+    for i, (address, section_size, crc32, operation, source) in \
+            enumerate(entries):
+        if operation == Delta.KEEP:
+            data = read(address, section_size)
+        elif operation == Delta.COPY:
+            data = read(source, section_size)
+        else:
+            start = data_offset + source
+            data = delta[start:start+section_size]
+        Archive.Assertion.do(
+            len(data) == section_size and
+            binascii.crc32(data) & 0xFFFFFFFF == crc32,
+            i, "bad {} section data".format(
+                "delta" if operation == Delta.DATA else "base"
+            )
+        )
+        if operation != Delta.KEEP:
+            sections[i] = data
+
+    # Header and table entries
+    header = bytearray(b"RSBJ")
+    header.extend(struct.pack("<I", section_count))
+    for address, section_size, crc32, _, _ in entries:
+        header.extend(Delta.TABLE_ENTRY.pack(address, section_size, crc32))
+    for start, end in [(0, 8)] + [
+        (8 + 12 * i, 20 + 12 * i) for i in range(section_count)
+    ]:
+        chunk = header[start:end]
+        if base_header[start:end] != chunk:
+            f.seek(start)
+            f.write(chunk)
+
+    # Sections and padding
+    for i in sorted(sections):
+        f.seek(entries[i][0])
+        f.write(sections[i])
+    if entries:
+        end = max(address + s for address, s, _, _, _ in entries)
+    else:
+        end = len(header)
+    padding = bytearray(size - end)
+    if read(end, len(padding)) != padding:
+        f.seek(end)
+        f.write(padding)
+    f.truncate(size)
+    f.flush()
+
+    for i, (address, section_size, crc32, _, _) in enumerate(entries):
+        Archive.Assertion.do(
+            binascii.crc32(read(address, section_size)) & 0xFFFFFFFF == crc32,
+            i, "bad crc32 after applying delta"
+        )
+    return sorted(sections)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from archive import LazyArchive
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-c", "--create",
+                       type=str, nargs=2, metavar=("BASE", "NEW"),
+                       help="create a delta between two archive files")
+    group.add_argument("-a", "--apply",
+                       type=str, metavar="BASE",
+                       help="apply a delta to an archive file in place")
+    parser.add_argument("delta",
+                        type=str,
+                        help="delta file")
+
+    args = parser.parse_args()
+    if args.create:
+        base, new = args.create
+        with open(base, "rb") as f:
+            delta = diff_file(f, LazyArchive.open(new))
+        with open(args.delta, "wb") as f:
+            f.write(delta)
+    if args.apply:
+        with open(args.delta, "rb") as f:
+            delta = f.read()
+        with open(args.apply, "rb+") as f:
+            print("{} sections written".format(len(apply(f, delta))))
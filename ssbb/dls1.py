@@ -26,33 +26,128 @@ from collections import namedtuple
 
 
 def bitfield(cls):
-    """Bitfield helper."""
+    """Bitfield helper.
+
+    Masks are decoded a byte at a time using per-byte lookup tables, batch
+    helpers work on NumPy arrays of 64-bit masks.
+    """
     # Define bitfield's bits
     bits = cls.BITS
+    bit_map = {}
     for i, name in enumerate(cls.BITS):
         setattr(cls, name, 1 << i)
+        bit_map[name] = 1 << i
+    # Per-byte lookup tables of enabled/disabled bit names
+    enabled_tables = []
+    disabled_tables = []
+    for shift in range(0, len(bits), 8):
+        names = bits[shift:shift+8]
+        enabled_tables.append([
+            tuple(name for i, name in enumerate(names) if value & (1 << i))
+            for value in range(256)
+        ])
+        disabled_tables.append([
+            tuple(
+                name for i, name in enumerate(names)
+                if not (value & (1 << i))
+            )
+            for value in range(256)
+        ])
+
+    def lookup(tables, value):
+        names = []
+        for table in tables:
+            names.extend(table[value & 0xFF])
+            value >>= 8
+        return names
+
+    def mask(names):
+        value = 0
+        for name in names:
+            value |= bit_map[name]
+        return value
+
+    def to_matrix(values):
+        import numpy
+        values = numpy.asarray(values, dtype=numpy.uint64).reshape(-1, 1)
+        matrix = numpy.zeros((len(values), len(bits)), dtype=bool)
+        width = min(len(bits), 64)
+        shifts = numpy.arange(width, dtype=numpy.uint64)
+        matrix[:, :width] = (values >> shifts) & numpy.uint64(1)
+        return matrix
+
+    def from_matrix(matrix):
+        import numpy
+        matrix = numpy.asarray(matrix, dtype=bool)
+        width = min(len(bits), 64)
+        shifts = numpy.arange(width, dtype=numpy.uint64)
+        return numpy.bitwise_or.reduce(
+            matrix[:, :width].astype(numpy.uint64) << shifts, axis=1
+        )
+
+    def count(values):
+        return dict(zip(bits, to_matrix(values).sum(axis=0).tolist()))
+
     # Define bitfield's methods
-    cls.enabled = staticmethod(
-        lambda value: [
-            name
-            for i, name in enumerate(bits)
-            if value & (1 << i)
-        ]
-    )
-    cls.disabled = staticmethod(
-        lambda value: [
-            name
-            for i, name in enumerate(bits)
-            if not (value & (1 << i))
-        ]
-    )
+    cls.enabled = staticmethod(lambda value: lookup(enabled_tables, value))
+    cls.disabled = staticmethod(lambda value: lookup(disabled_tables, value))
+    cls.mask = staticmethod(mask)
+    cls.masks = staticmethod(lambda name_lists: [mask(n) for n in name_lists])
+    cls.to_matrix = staticmethod(to_matrix)
+    cls.from_matrix = staticmethod(from_matrix)
+    cls.count = staticmethod(count)
     return cls
 
 
 class Setting(object):
     """SSBB Setting."""
 
+    __slots__ = [
+        "padding", "header", "crc32",
+        "contribute", "is_infinity_contribute", "collection_lifetime",
+        "unknown_0x03",
+        "contribute_start", "contribute_end",
+        "watch_start", "watch_end",
+        "deliv_start", "deliv_end",
+        "upload_size_limit",
+        "enable_upload_character", "enable_upload_stage",
+        "spectator_misc"
+    ]
+
     Date = namedtuple("SettingDate", ["year", "month", "day"])
+    DATE_START = Date(2000, 1, 1)
+    DATE_END = Date(2123, 12, 31)
+    HEADER = (
+        0x00, 0x00, 0x00, 0xdb,
+        0x00, 0x00, 0x00, 0x63,
+        0x00, 0x00, 0x00, 0x63
+    )
+
+    # Fixed 0x4C-byte layout followed by spectator_misc
+    LAYOUT = struct.Struct(">16s4s12sBBBB" + "HBB" * 6 + "QQ")
+    CRC32 = struct.Struct(">I")
+    CRC32_PLACEHOLDER = b"\xDE\xAD\xBE\xEF"
+
+    # NumPy dtype of unpack_settings() records
+    DATE_DTYPE = [("year", ">u2"), ("month", "u1"), ("day", "u1")]
+    DTYPE = [
+        ("padding", "u1", (0x10,)),
+        ("crc32", ">u4"),
+        ("header", "u1", (12,)),
+        ("contribute", "u1"),
+        ("is_infinity_contribute", "u1"),
+        ("collection_lifetime", "u1"),
+        ("unknown_0x03", "u1"),
+        ("contribute_start", DATE_DTYPE),
+        ("contribute_end", DATE_DTYPE),
+        ("watch_start", DATE_DTYPE),
+        ("watch_end", DATE_DTYPE),
+        ("deliv_start", DATE_DTYPE),
+        ("deliv_end", DATE_DTYPE),
+        ("enable_upload_character", ">u8"),
+        ("enable_upload_stage", ">u8"),
+        ("crc32_valid", "?")
+    ]
 
     class Contribute:
         """Contribute flags."""
@@ -160,22 +255,18 @@ class Setting(object):
 
     def __init__(self):
         self.padding = bytearray(0x10)
-        self.header = [
-            0x00, 0x00, 0x00, 0xdb,
-            0x00, 0x00, 0x00, 0x63,
-            0x00, 0x00, 0x00, 0x63
-        ]
-        self.crc32 = bytearray.fromhex("DEADBEEF")
+        self.header = list(Setting.HEADER)
+        self.crc32 = bytearray(Setting.CRC32_PLACEHOLDER)
         self.contribute = 0
         self.is_infinity_contribute = 0
         self.collection_lifetime = 0
         self.unknown_0x03 = 0
-        self.contribute_start = Setting.Date(2000, 1, 1)
-        self.contribute_end = Setting.Date(2123, 12, 31)
-        self.watch_start = Setting.Date(2000, 1, 1)
-        self.watch_end = Setting.Date(2123, 12, 31)
-        self.deliv_start = Setting.Date(2000, 1, 1)
-        self.deliv_end = Setting.Date(2123, 12, 31)
+        self.contribute_start = Setting.DATE_START
+        self.contribute_end = Setting.DATE_END
+        self.watch_start = Setting.DATE_START
+        self.watch_end = Setting.DATE_END
+        self.deliv_start = Setting.DATE_START
+        self.deliv_end = Setting.DATE_END
         self.upload_size_limit = 0
         self.enable_upload_character = 0
         self.enable_upload_stage = 0
@@ -214,78 +305,113 @@ spectator_misc: {!r}""".format(
         )
         return repr
 
-    def pack(self):
-        # Header
-        setting = bytearray(self.padding)
-        setting.extend(bytearray.fromhex("DEADBEEF"))  # CRC32
-        setting.extend(self.header)
-
-        # Setting
-        setting.extend(struct.pack(
-            ">BBBB",
-            self.contribute,
-            self.is_infinity_contribute,
-            self.collection_lifetime,
-            self.unknown_0x03,
-        ))
-        setting.extend(struct.pack(">HBB", *self.contribute_start))
-        setting.extend(struct.pack(">HBB", *self.contribute_end))
-        setting.extend(struct.pack(">HBB", *self.watch_start))
-        setting.extend(struct.pack(">HBB", *self.watch_end))
-        setting.extend(struct.pack(">HBB", *self.deliv_start))
-        setting.extend(struct.pack(">HBB", *self.deliv_end))
-        setting.extend(struct.pack(
-            ">QQ",
-            self.enable_upload_character,
-            self.enable_upload_stage
-        ))
+    def _pack_fields(self):
+        """Return the packed setting with a CRC32 placeholder."""
+        setting = bytearray(Setting.LAYOUT.pack(*(
+            (
+                bytes(self.padding),
+                Setting.CRC32_PLACEHOLDER,
+                bytes(bytearray(self.header)),
+                self.contribute,
+                self.is_infinity_contribute,
+                self.collection_lifetime,
+                self.unknown_0x03,
+            )
+            + tuple(self.contribute_start) + tuple(self.contribute_end)
+            + tuple(self.watch_start) + tuple(self.watch_end)
+            + tuple(self.deliv_start) + tuple(self.deliv_end)
+            + (self.enable_upload_character, self.enable_upload_stage)
+        )))
         setting.extend(self.spectator_misc)
+        return setting
+
+    def pack(self):
+        setting = self._pack_fields()
 
         # CRC32
         self.crc32 = binascii.crc32(setting) & 0xFFFFFFFF
-        setting[0x10:0x14] = struct.pack(">I", self.crc32)
+        Setting.CRC32.pack_into(setting, 0x10, self.crc32)
 
         return setting
 
     def unpack(self, data, ignore_errors=False):
-        self.crc32 = struct.unpack_from(">I", data, 0x10)[0]
-        data[0x10:0x14] = bytearray.fromhex("DEADBEEF")
+        self.crc32, = Setting.CRC32.unpack_from(data, 0x10)
+        data[0x10:0x14] = Setting.CRC32_PLACEHOLDER
         crc32 = binascii.crc32(data) & 0xFFFFFFFF
         if not ignore_errors:
             assert crc32 == self.crc32, "CRC32 mismatch"
-        data[0x10:0x14] = struct.pack(">I", crc32)
+        Setting.CRC32.pack_into(data, 0x10, crc32)
 
+        fields = Setting.LAYOUT.unpack_from(data)
         self.padding = data[:0x10]
         self.header = data[0x14:0x20]
-        self.contribute = struct.unpack_from(">B", data, 0x20)[0]
-        self.is_infinity_contribute = struct.unpack_from(">B", data, 0x21)[0]
-        self.collection_lifetime = struct.unpack_from(">B", data, 0x22)[0]
-        self.unknown_0x03 = struct.unpack_from(">B", data, 0x23)[0]
-        self.contribute_start = Setting.Date(
-            *struct.unpack_from(">HBB", data, 0x24)
-        )
-        self.contribute_end = Setting.Date(
-            *struct.unpack_from(">HBB", data, 0x28)
-        )
-        self.watch_start = Setting.Date(
-            *struct.unpack_from(">HBB", data, 0x2C)
-        )
-        self.watch_end = Setting.Date(
-            *struct.unpack_from(">HBB", data, 0x30)
-        )
-        self.deliv_start = Setting.Date(
-            *struct.unpack_from(">HBB", data, 0x34)
-        )
-        self.deliv_end = Setting.Date(
-            *struct.unpack_from(">HBB", data, 0x38)
-        )
-        self.enable_upload_character = struct.unpack_from(">Q", data, 0x3C)[0]
-        self.enable_upload_stage = struct.unpack_from(">Q", data, 0x44)[0]
-        self.spectator_misc = data[0x4C:]
+        (
+            self.contribute,
+            self.is_infinity_contribute,
+            self.collection_lifetime,
+            self.unknown_0x03
+        ) = fields[3:7]
+        self.contribute_start = Setting.Date._make(fields[7:10])
+        self.contribute_end = Setting.Date._make(fields[10:13])
+        self.watch_start = Setting.Date._make(fields[13:16])
+        self.watch_end = Setting.Date._make(fields[16:19])
+        self.deliv_start = Setting.Date._make(fields[19:22])
+        self.deliv_end = Setting.Date._make(fields[22:25])
+        self.enable_upload_character, self.enable_upload_stage = fields[25:]
+        self.spectator_misc = data[Setting.LAYOUT.size:]
 
         return self
 
 
+def unpack_settings(sections, ignore_errors=False):
+    """Unpack many settings into a NumPy structured array.
+
+    Record fields match Setting.DTYPE: the fixed-size Setting fields, dates
+    being (year, month, day) records, and crc32_valid. The spectator_misc
+    data isn't decoded. Each CRC32 is checked while gathering its record,
+    so the whole batch is decoded in a single pass.
+    """
+    import numpy
+
+    size = Setting.LAYOUT.size
+    records = bytearray()
+    for i, data in enumerate(sections):
+        data = memoryview(data)
+        valid = len(data) >= size
+        if valid:
+            crc32 = binascii.crc32(data[:0x10])
+            crc32 = binascii.crc32(Setting.CRC32_PLACEHOLDER, crc32)
+            crc32 = binascii.crc32(data[0x14:], crc32) & 0xFFFFFFFF
+            valid = crc32 == Setting.CRC32.unpack_from(data, 0x10)[0]
+            records.extend(data[:size])
+        else:
+            records.extend(data)
+            records.extend(bytearray(size - len(data)))
+        if not ignore_errors:
+            assert valid, "CRC32 mismatch (setting {})".format(i)
+        records.append(valid)
+    return numpy.frombuffer(records, dtype=numpy.dtype(Setting.DTYPE))
+
+
+def iter_settings(f, name="WIFI", ignore_errors=False):
+    """Decrypt, unpack and parse the settings of a DLS1 file in one pass.
+
+    f is a file-like object encrypted with the KEY_IV_MAP name key (or in
+    plain text if name is None). Yield (index, Setting) tuples without
+    writing intermediate files or keeping the whole file in memory.
+    """
+    from archive import iter_unpack
+    from crypto import CHUNK_SIZE, KEY_IV_MAP, decrypt_stream
+
+    if name is None:
+        chunks = iter(lambda: f.read(CHUNK_SIZE), b"")
+    else:
+        key, iv = KEY_IV_MAP[name]
+        chunks = decrypt_stream(f, key, iv)
+    for i, section in iter_unpack(chunks, ignore_errors):
+        yield i, Setting().unpack(section.data, ignore_errors)
+
+
 def _test():
     """Recreate s20130702_1.bin."""
     MISC = bytearray.fromhex(
@@ -368,6 +494,22 @@ def _new():
         f.write(archive.pack())
 
 
+def _bench(number=10000):
+    """Print Setting pack/unpack time per object."""
+    import timeit
+
+    s = Setting()
+    s.spectator_misc = bytearray(0x3F)
+    data = s.pack()
+    for name, stmt in (
+        ("Setting()", Setting),
+        ("Setting.pack", s.pack),
+        ("Setting.unpack", lambda: Setting().unpack(data))
+    ):
+        t = min(timeit.repeat(stmt, number=number, repeat=3))
+        print("{}: {:.2f} us".format(name, t / number * 1e6))
+
+
 if __name__ == "__main__":
     example = r"""
 # Run it with: python -i
@@ -383,5 +525,11 @@ a = Archive().unpack(data)
 from dls1 import Setting
 s = Setting().unpack(a[0].data)
 print(s)
+
+# Or decrypt, unpack and parse the encrypted file in one pass
+from dls1 import iter_settings
+with open("s20130702_1.bin", "rb") as f:
+    for i, s in iter_settings(f):
+        print(s)
 """
     print(example)
@@ -0,0 +1,300 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB archive index module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sqlite3
+import struct
+
+from archive import file_reader, unpack_section, unpack_table
+from dls1 import Setting
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    error TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS sections (
+    path TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    address INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL,
+    PRIMARY KEY (path, idx)
+);
+CREATE INDEX IF NOT EXISTS sections_crc32 ON sections (crc32, size);
+CREATE TABLE IF NOT EXISTS settings (
+    path TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL,
+    contribute INTEGER,
+    is_infinity_contribute INTEGER,
+    collection_lifetime INTEGER,
+    unknown_0x03 INTEGER,
+    contribute_start INTEGER,
+    contribute_end INTEGER,
+    watch_start INTEGER,
+    watch_end INTEGER,
+    deliv_start INTEGER,
+    deliv_end INTEGER,
+    enable_upload_character INTEGER,
+    enable_upload_stage INTEGER,
+    PRIMARY KEY (path, idx)
+);
+"""
+
+SETTING_COLUMNS = [
+    "contribute", "is_infinity_contribute", "collection_lifetime",
+    "unknown_0x03",
+    "contribute_start", "contribute_end",
+    "watch_start", "watch_end",
+    "deliv_start", "deliv_end",
+    "enable_upload_character", "enable_upload_stage"
+]
+
+
+def date_key(date):
+    """Convert a Setting.Date to its YYYYMMDD integer column value."""
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def mask_key(value):
+    """Convert a 64-bit mask to a signed SQLite integer."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def mask_value(key):
+    """Convert a signed SQLite integer back to a 64-bit mask."""
+    return key & 0xFFFFFFFFFFFFFFFF
+
+
+def _setting_row(setting):
+    row = []
+    for column in SETTING_COLUMNS:
+        value = getattr(setting, column)
+        if isinstance(value, Setting.Date):
+            value = date_key(value)
+        elif column.startswith("enable_upload_"):
+            value = mask_key(value)
+        row.append(value)
+    return row
+
+
+class Index(object):
+    """SQLite catalog of Archive files, sections and settings.
+
+    Dates are stored as YYYYMMDD integers and 64-bit masks as signed
+    integers (see mask_value), so lookups never touch the archives.
+    """
+
+    def __init__(self, path):
+        """Open or create the index database."""
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        columns = [
+            row[1] for row in self.db.execute("PRAGMA table_info(files)")
+        ]
+        if "name" not in columns:  # Indexed before keys were recorded
+            with self.db:
+                self.db.execute("ALTER TABLE files ADD COLUMN name TEXT")
+
+    def close(self):
+        self.db.close()
+
+    def _forget(self, path):
+        for table in ("files", "sections", "settings"):
+            self.db.execute(
+                "DELETE FROM {} WHERE path = ?".format(table), (path,)
+            )
+
+    def _scan(self, path, offset, name):
+        """Index a single archive file."""
+        with open(path, "rb") as f:
+            if name is None:
+                read = file_reader(f, offset)
+            else:
+                from crypto import KEY_IV_MAP, range_reader
+                decrypt = range_reader(f, *KEY_IV_MAP[name])
+
+                def read(address, size):
+                    return decrypt(offset + address, size)
+            table = unpack_table(read)
+            for i, (address, size, crc32) in enumerate(table):
+                self.db.execute(
+                    "INSERT INTO sections VALUES (?, ?, ?, ?, ?)",
+                    (path, i, address, size, crc32)
+                )
+                # Archive errors (e.g. bad CRC32) are recorded by update()
+                data = unpack_section(read, i, False, table).data
+                if size < Setting.LAYOUT.size:
+                    continue
+                try:
+                    setting = Setting().unpack(data)
+                except (AssertionError, ValueError, struct.error):
+                    continue  # Not a setting
+                self.db.execute(
+                    "INSERT INTO settings VALUES ({})".format(
+                        ", ".join("?" * (3 + len(SETTING_COLUMNS)))
+                    ),
+                    [path, i, setting.crc32] + _setting_row(setting)
+                )
+
+    def update(self, paths, offset=0, name=None, prune=False):
+        """Index new or modified archive files.
+
+        Files whose mtime, size, offset and key didn't change are skipped.
+        Encrypted files are indexed using the KEY_IV_MAP name key. If prune
+        is True, indexed files missing from paths are removed. Return the
+        number of (indexed, skipped) files.
+        """
+        indexed = skipped = 0
+        seen = set()
+        for path in paths:
+            path = os.path.abspath(path)
+            seen.add(path)
+            stat = os.stat(path)
+            row = self.db.execute(
+                "SELECT mtime, size, offset, name FROM files"
+                " WHERE path = ?", (path,)
+            ).fetchone()
+            # The key name is "" for plain files, NULL in older indexes
+            if row == (stat.st_mtime, stat.st_size, offset, name or ""):
+                skipped += 1
+                continue
+            with self.db:
+                self._forget(path)
+                error = None
+                try:
+                    self._scan(path, offset, name)
+                except (AssertionError, IOError, OSError) as e:
+                    self._forget(path)
+                    error = str(e)
+                self.db.execute(
+                    "INSERT INTO files"
+                    " (path, mtime, size, offset, error, name)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, stat.st_mtime, stat.st_size, offset, error,
+                     name or "")
+                )
+            indexed += 1
+        if prune:
+            with self.db:
+                for path, in self.db.execute(
+                    "SELECT path FROM files"
+                ).fetchall():
+                    if path not in seen:
+                        self._forget(path)
+        return indexed, skipped
+
+    def find_crc32(self, crc32, size=None):
+        """Return (path, index) of sections matching crc32 (and size)."""
+        query = "SELECT path, idx FROM sections WHERE crc32 = ?"
+        params = [crc32]
+        if size is not None:
+            query += " AND size = ?"
+            params.append(size)
+        query += " ORDER BY path, idx"
+        return self.db.execute(query, params).fetchall()
+
+    def duplicates(self):
+        """Return (crc32, size, count) of sections stored more than once."""
+        return self.db.execute(
+            "SELECT crc32, size, COUNT(*) FROM sections"
+            " GROUP BY crc32, size HAVING COUNT(*) > 1"
+            " ORDER BY COUNT(*) DESC, crc32, size"
+        ).fetchall()
+
+    def find_settings(self, **fields):
+        """Return (path, index) of settings whose columns match fields.
+
+        Dates and masks are converted to their column representation.
+        """
+        query = "SELECT path, idx FROM settings"
+        params = []
+        conditions = []
+        for column, value in sorted(fields.items()):
+            if column not in SETTING_COLUMNS and column != "crc32":
+                raise ValueError("unknown setting column: {}".format(column))
+            if isinstance(value, Setting.Date):
+                value = date_key(value)
+            elif column.startswith("enable_upload_"):
+                value = mask_key(value)
+            conditions.append("{} = ?".format(column))
+            params.append(value)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY path, idx"
+        return self.db.execute(query, params).fetchall()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import batch
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database",
+                        type=str,
+                        help="SQLite index file")
+    parser.add_argument("-u", "--update",
+                        type=str, nargs="+", metavar="FILE",
+                        help="index archive files, directories or globs")
+    parser.add_argument("--pattern",
+                        type=str, default="*",
+                        help="files to index in directories")
+    parser.add_argument("-o", "--offset",
+                        type=int, default=0,
+                        help="archive offset in files")
+    parser.add_argument("-k", "--key",
+                        type=str, choices=["WIFI", "SD"],
+                        help="index files encrypted with this key")
+    parser.add_argument("--prune",
+                        action="store_true",
+                        help="remove indexed files not given to --update")
+    parser.add_argument("-c", "--crc32",
+                        type=lambda value: int(value, 16),
+                        help="find sections by CRC32 (hexadecimal)")
+    parser.add_argument("--duplicates",
+                        action="store_true",
+                        help="list sections stored more than once")
+
+    args = parser.parse_args()
+    index = Index(args.database)
+    try:
+        if args.update:
+            indexed, skipped = index.update(
+                batch.expand(args.update, args.pattern),
+                args.offset, args.key, args.prune
+            )
+            print("{} files indexed, {} unchanged".format(indexed, skipped))
+        if args.crc32 is not None:
+            for path, i in index.find_crc32(args.crc32):
+                print("{} [Section {}]".format(path, i))
+        if args.duplicates:
+            for crc32, size, count in index.duplicates():
+                print("0x{:08x} {} bytes: {} copies".format(
+                    crc32, size, count
+                ))
+    finally:
+        index.close()
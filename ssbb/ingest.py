@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB upload ingest module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from collections import namedtuple
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from archive import unpack
+from batch import expand
+from crypto import KEY_IV_MAP, decrypt
+from dls1 import Setting
+
+Summary = namedtuple("IngestSummary", [
+    "files", "accepted", "size", "rejections", "max_queue", "elapsed"
+])
+
+
+class Ingest(object):
+    """Pipeline storing uploaded contributions from a spool directory.
+
+    Uploads are encrypted archives spooled by kind:
+    spool/replays/*, spool/album/* and spool/stages/*
+
+    Each upload is checked against the setting (contribute flags and size
+    limit), decrypted, unpacked with its section CRCs checked and saved to
+    the Store under "<kind>_<file name>".
+    """
+
+    KINDS = {
+        "replays": Setting.Contribute.REPLAYS,
+        "album": Setting.Contribute.ALBUM,
+        "stages": Setting.Contribute.STAGES,
+    }
+
+    def __init__(self, store, limit, setting=None, name="WIFI",
+                 workers=None, queue_size=None):
+        """Create an ingest pipeline.
+
+        limit is the upload size limit in bytes. It is required since
+        upload_size_limit isn't part of the packed setting (unpacked
+        settings leave it to 0) and its unit is unknown. Without setting,
+        every kind is accepted. Uploads are processed by workers threads
+        (all CPUs by default) fed by a queue of queue_size uploads (twice
+        workers by default), blocking the spool scan when full.
+        """
+        if not limit or limit < 0:
+            raise ValueError("invalid upload size limit: {}".format(limit))
+        self.store = store
+        self.setting = setting
+        self.name = name
+        self.limit = limit
+        self.workers = workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size or 2 * self.workers
+
+    def accepts(self, kind):
+        """Return whether the setting accepts uploads of kind."""
+        if kind not in Ingest.KINDS:
+            return False
+        return self.setting is None or \
+            bool(self.setting.contribute & Ingest.KINDS[kind])
+
+    def process(self, kind, path):
+        """Check and store an upload, return its size.
+
+        Rejected uploads raise ValueError (setting) or AssertionError
+        (archive).
+        """
+        if not self.accepts(kind):
+            raise ValueError("{} uploads are disabled".format(kind))
+        size = os.path.getsize(path)
+        if size > self.limit:
+            raise ValueError("size ({}) over the limit ({})".format(
+                size, self.limit
+            ))
+        with open(path, "rb") as f:
+            data = f.read()
+        archive = unpack(decrypt(data, *KEY_IV_MAP[self.name]), copy=False)
+        self.store.save("{}_{}".format(kind, os.path.basename(path)), archive)
+        return size
+
+    def _worker(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            kind, path = task
+            try:
+                results.append((path, self.process(kind, path), None))
+            except Exception as e:  # A dead worker would block run()
+                results.append((path, 0, "{}: {}".format(
+                    type(e).__name__, e
+                )))
+
+    def run(self, spool, pattern="*", remove=False):
+        r"""Process the uploads of the spool directory, return a Summary.
+
+        If remove is True, accepted uploads are deleted from the spool.
+
+        >>> import shutil, tempfile
+        >>> from crypto import encrypt
+        >>> from store import Store
+        >>> root = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(root, "spool", "replays"))
+        >>> # Truncated upload: 100 sections announced, none in the table
+        >>> truncated = b"RSBJ" + b"\x64\0\0\0" + b"\0" * 8
+        >>> path = os.path.join(root, "spool", "replays", "truncated.bin")
+        >>> with open(path, "wb") as f:
+        ...     _ = f.write(encrypt(truncated, *KEY_IV_MAP["WIFI"]))
+        >>> store = Store(os.path.join(root, "store"))
+        >>> ingest = Ingest(store, 0x400, workers=2)
+        >>> summary = ingest.run(os.path.join(root, "spool"))
+        >>> summary.files, summary.accepted
+        (1, 0)
+        >>> summary.rejections[0][1]
+        'Assertion: [Header] truncated section table'
+        >>> shutil.rmtree(root)
+        """
+        start = time.time()
+        tasks = queue.Queue(self.queue_size)
+        results = []  # list.append is atomic
+        threads = [
+            threading.Thread(target=self._worker, args=(tasks, results))
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        max_queue = 0
+        files = 0
+        for kind in sorted(os.listdir(spool)):
+            directory = os.path.join(spool, kind)
+            if not os.path.isdir(directory):
+                continue
+            for path in expand([directory], pattern):
+                tasks.put((kind, path))  # Blocks while the queue is full
+                max_queue = max(max_queue, tasks.qsize())
+                files += 1
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+        size = 0
+        rejections = []
+        for path, processed, error in results:
+            if error:
+                rejections.append((path, error))
+                continue
+            size += processed
+            if remove:
+                os.remove(path)
+        return Summary(
+            files, len(results) - len(rejections), size, sorted(rejections),
+            max_queue, time.time() - start
+        )
+
+
+def report(summary, out=sys.stderr):
+    """Print rejected uploads and throughput."""
+    for path, error in summary.rejections:
+        out.write("{}: {}\n".format(path, error))
+    elapsed = summary.elapsed or 1e-9
+    out.write(
+        "{} uploads ({} accepted, {} rejected), {:.2f} MB in {:.2f}s: "
+        "{:.1f} uploads/s, {:.2f} MB/s, max queue depth {}\n".format(
+            summary.files, summary.accepted, len(summary.rejections),
+            summary.size / 1e6, summary.elapsed, summary.files / elapsed,
+            summary.size / 1e6 / elapsed, summary.max_queue
+        )
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dls1 import iter_settings
+    from store import Store
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spool",
+                        type=str,
+                        help="spool directory of uploads by kind")
+    parser.add_argument("store",
+                        type=str,
+                        help="store directory of accepted uploads")
+    parser.add_argument("-S", "--setting",
+                        type=str,
+                        help="encrypted setting file of the uploads")
+    parser.add_argument("-s", "--sd",
+                        action="store_true",
+                        help="use SD key")
+    parser.add_argument("-l", "--limit",
+                        type=int, required=True,
+                        help="upload size limit in bytes")
+    parser.add_argument("-j", "--jobs",
+                        type=int, default=0,
+                        help="worker threads (0 uses all CPUs)")
+    parser.add_argument("-q", "--queue",
+                        type=int, default=0,
+                        help="pending uploads (0 uses twice the workers)")
+    parser.add_argument("--pattern",
+                        type=str, default="*",
+                        help="upload files in spool directories")
+    parser.add_argument("--remove",
+                        action="store_true",
+                        help="remove accepted uploads from the spool")
+
+    args = parser.parse_args()
+    name = "SD" if args.sd else "WIFI"
+    setting = None
+    if args.setting:
+        with open(args.setting, "rb") as f:
+            _, setting = next(iter_settings(f, name))
+    ingest = Ingest(
+        Store(args.store), args.limit, setting, name, args.jobs, args.queue
+    )
+    summary = ingest.run(args.spool, args.pattern, args.remove)
+    report(summary)
+    if summary.rejections:
+        sys.exit(1)
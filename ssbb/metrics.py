@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB metrics module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii
+import functools
+import sys
+import threading
+import time
+
+import archive
+import crypto
+import dls1
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, float("inf"))
+
+
+class Stage(object):
+    """Counters of an instrumented stage."""
+
+    __slots__ = ["calls", "bytes", "seconds", "histogram"]
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.histogram = [0] * len(BUCKETS)
+
+
+_stages = {}
+_hooks = []
+_lock = threading.Lock()
+_patches = []
+
+
+def record(stage, size, seconds):
+    """Record a call of stage processing size bytes in seconds."""
+    with _lock:
+        counters = _stages.get(stage)
+        if counters is None:
+            counters = _stages[stage] = Stage()
+        counters.calls += 1
+        counters.bytes += size
+        counters.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counters.histogram[i] += 1
+                break
+    for hook in _hooks:
+        hook(stage, size, seconds)
+
+
+def add_hook(hook):
+    """Call hook(stage, size, seconds) after each instrumented call."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _wrap(stage, func, size):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = _clock()
+        result = func(*args, **kwargs)
+        elapsed = _clock() - start
+        try:
+            processed = size(args, kwargs, result)
+        except Exception:  # Instrumentation must not change behaviour
+            processed = 0
+        record(stage, processed, elapsed)
+        return result
+    return wrapper
+
+
+def _input_size(args, kwargs, result):
+    return len(args[0] if args else kwargs["data"])
+
+
+def _method_input_size(args, kwargs, result):
+    return len(args[1] if len(args) > 1 else kwargs["data"])
+
+
+def _output_size(args, kwargs, result):
+    return len(result)
+
+
+class _Binascii(object):
+    """binascii module with an instrumented crc32."""
+
+    def __init__(self, crc32):
+        self.crc32 = crc32
+
+    def __getattr__(self, name):
+        return getattr(binascii, name)
+
+
+def _patch(obj, name, value):
+    _patches.append((obj, name, obj.__dict__[name]))
+    setattr(obj, name, value)
+
+
+def _patch_function(module, name, stage, size):
+    """Instrument a function wherever it was imported under its name."""
+    func = getattr(module, name)
+    wrapper = _wrap(stage, func, size)
+    for other in list(sys.modules.values()):
+        if getattr(other, name, None) is func:
+            _patch(other, name, wrapper)
+
+
+def enabled():
+    return bool(_patches)
+
+
+def enable():
+    """Instrument crypto, Archive, CRC32 and Setting stages.
+
+    Functions are only wrapped while enabled, so disabled instrumentation
+    costs nothing. Functions imported by name after enable() aren't
+    instrumented.
+    """
+    if _patches:
+        return
+    _patch_function(crypto, "encrypt", "crypto.encrypt", _input_size)
+    _patch_function(crypto, "decrypt", "crypto.decrypt", _input_size)
+    _patch_function(archive, "_zlib_crc32", "crc32", _input_size)
+    crc32 = _Binascii(_wrap("crc32", binascii.crc32, _input_size))
+    for module in (archive, dls1):
+        _patch(module, "binascii", crc32)
+    for cls, name, stage, size in (
+        (archive.Archive, "pack", "archive.pack", _output_size),
+        (archive.Archive, "unpack", "archive.unpack", _method_input_size),
+        (dls1.Setting, "pack", "setting.pack", _output_size),
+        (dls1.Setting, "unpack", "setting.unpack", _method_input_size),
+    ):
+        _patch(cls, name, _wrap(stage, cls.__dict__[name], size))
+
+
+def disable():
+    """Restore uninstrumented functions, counters are kept."""
+    while _patches:
+        obj, name, value = _patches.pop()
+        setattr(obj, name, value)
+
+
+def reset():
+    """Clear stage counters."""
+    with _lock:
+        _stages.clear()
+
+
+def snapshot():
+    """Return stage counters as a dict.
+
+    Histograms map bucket upper bounds to non-cumulative call counts.
+    """
+    with _lock:
+        return {
+            stage: {
+                "calls": counters.calls,
+                "bytes": counters.bytes,
+                "seconds": counters.seconds,
+                "histogram": dict(zip(BUCKETS, counters.histogram)),
+            }
+            for stage, counters in _stages.items()
+        }
+
+
+def prometheus(prefix="ssbb"):
+    """Return stage counters in Prometheus text exposition format."""
+    def bound(value):
+        return "+Inf" if value == float("inf") else repr(value)
+
+    stages = sorted(snapshot().items())
+    lines = []
+    for name in ("calls", "bytes"):
+        lines.append("# TYPE {}_stage_{}_total counter".format(prefix, name))
+        for stage, counters in stages:
+            lines.append('{}_stage_{}_total{{stage="{}"}} {}'.format(
+                prefix, name, stage, counters[name]
+            ))
+    lines.append("# TYPE {}_stage_seconds histogram".format(prefix))
+    for stage, counters in stages:
+        label = 'stage="{}"'.format(stage)
+        count = 0
+        for upper in BUCKETS:
+            count += counters["histogram"][upper]
+            lines.append('{}_stage_seconds_bucket{{{},le="{}"}} {}'.format(
+                prefix, label, bound(upper), count
+            ))
+        lines.append("{}_stage_seconds_sum{{{}}} {!r}".format(
+            prefix, label, counters["seconds"]
+        ))
+        lines.append("{}_stage_seconds_count{{{}}} {}".format(
+            prefix, label, counters["calls"]
+        ))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB setting schedule module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import json
+
+from collections import namedtuple
+
+from index import date_key, mask_value
+
+WINDOWS = ("contribute", "watch", "deliv")
+
+Record = namedtuple("ScheduleRecord", [
+    "label", "contribute",
+    "enable_upload_character", "enable_upload_stage",
+    "contribute_start", "contribute_end",
+    "watch_start", "watch_end",
+    "deliv_start", "deliv_end"
+])
+
+
+def _key(date):
+    """Return the YYYYMMDD key of a date, date-like object or key."""
+    if isinstance(date, int):
+        return date
+    return date_key(date)
+
+
+class Schedule(object):
+    """Interval index of Setting windows.
+
+    Windows are inclusive YYYYMMDD ranges. For each window type, the
+    window bounds split the calendar into segments whose active records
+    and live record are precomputed, so a date lookup is a binary search
+    over the bounds.
+    """
+
+    def __init__(self, records=()):
+        """Index Records."""
+        self.records = list(records)
+        self.windows = {window: self._build(window) for window in WINDOWS}
+
+    def _build(self, window):
+        start = Record._fields.index(window + "_start")
+        end = Record._fields.index(window + "_end")
+        events = {}
+        for i, record in enumerate(self.records):
+            if record[start] > record[end]:
+                continue  # Empty window
+            events.setdefault(record[start], []).append((1, i))
+            events.setdefault(record[end] + 1, []).append((0, i))
+        bounds = sorted(events)
+        segments = []
+        lives = []
+        active = set()
+        for bound in bounds:
+            for opening, i in events[bound]:
+                if opening:
+                    active.add(i)
+                else:
+                    active.discard(i)
+            segment = sorted(active)
+            segments.append(segment)
+            lives.append(max(
+                segment, key=lambda j: (self.records[j][start], j)
+            ) if segment else None)
+        return bounds, segments, lives
+
+    @classmethod
+    def from_settings(cls, items):
+        """Index (label, Setting) items."""
+        return cls(
+            Record(
+                label, setting.contribute,
+                setting.enable_upload_character,
+                setting.enable_upload_stage,
+                *[date_key(getattr(setting, field))
+                  for field in Record._fields[4:]]
+            )
+            for label, setting in items
+        )
+
+    @classmethod
+    def from_index(cls, index):
+        """Index the settings of an Index, labelled by (path, index)."""
+        rows = index.db.execute(
+            "SELECT path, idx, contribute,"
+            " enable_upload_character, enable_upload_stage,"
+            " contribute_start, contribute_end, watch_start, watch_end,"
+            " deliv_start, deliv_end FROM settings ORDER BY path, idx"
+        )
+        return cls(
+            Record(
+                (row[0], row[1]), row[2],
+                mask_value(row[3]), mask_value(row[4]), *row[5:]
+            )
+            for row in rows
+        )
+
+    def active(self, date, window="deliv"):
+        """Return the Records whose window contains date."""
+        bounds, segments, _ = self.windows[window]
+        i = bisect.bisect_right(bounds, _key(date)) - 1
+        if i < 0:
+            return []
+        return [self.records[j] for j in segments[i]]
+
+    def live(self, date, window="deliv"):
+        """Return the active Record started last (then indexed last) or None.
+        """
+        bounds, _, lives = self.windows[window]
+        i = bisect.bisect_right(bounds, _key(date)) - 1
+        if i < 0 or lives[i] is None:
+            return None
+        return self.records[lives[i]]
+
+    def uploads(self, date):
+        """Return the (contribute, character, stage) flags allowed at date.
+        """
+        record = self.live(date, "contribute")
+        if record is None:
+            return 0, 0, 0
+        return (
+            record.contribute,
+            record.enable_upload_character,
+            record.enable_upload_stage
+        )
+
+    def dump(self, f):
+        """Save the Schedule records as compact JSON.
+
+        Segments are quicker to rebuild than to load, so they aren't saved.
+        """
+        json.dump(
+            [list(record) for record in self.records],
+            f, separators=(",", ":")
+        )
+
+    @classmethod
+    def load(cls, f):
+        """Load a Schedule saved by dump()."""
+        records = []
+        for record in json.load(f):
+            label = record[0]
+            if isinstance(label, list):
+                label = tuple(label)
+            records.append(Record(label, *record[1:]))
+        return cls(records)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("schedule",
+                        type=str,
+                        help="schedule file")
+    parser.add_argument("-i", "--index",
+                        type=str,
+                        help="build the schedule from an index database")
+    parser.add_argument("-d", "--date",
+                        type=lambda value: int(value.replace("-", "")),
+                        help="print the settings active at YYYY-MM-DD")
+    parser.add_argument("-w", "--window",
+                        type=str, choices=WINDOWS, default="deliv",
+                        help="window type of the lookup")
+
+    args = parser.parse_args()
+    if args.index:
+        from index import Index
+
+        index = Index(args.index)
+        try:
+            schedule = Schedule.from_index(index)
+        finally:
+            index.close()
+        with open(args.schedule, "w") as f:
+            schedule.dump(f)
+    else:
+        with open(args.schedule, "r") as f:
+            schedule = Schedule.load(f)
+    if args.date is not None:
+        for record in schedule.active(args.date, args.window):
+            print(record.label)
@@ -0,0 +1,303 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""SSBB DLS1 distribution server module (Python 3.7+).
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import email.utils
+import os
+import re
+
+from urllib.parse import unquote
+
+from archive import validate
+from batch import atomic_open
+from crypto import KEY_IV_MAP, encrypt_file
+
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+}
+
+
+def parse_range(value, size):
+    """Parse a single byte range header.
+
+    Return a (start, end) tuple, None if the header must be ignored or
+    False if the range isn't satisfiable.
+
+    >>> parse_range("bytes=2-5", 10), parse_range("bytes=-3", 10)
+    ((2, 6), (7, 10))
+    >>> parse_range("bytes=5-3", 10), parse_range("bytes=10-", 10)
+    (None, False)
+    """
+    match = RANGE.match(value.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last or not int(last):
+            return False
+        return max(size - int(last), 0), size
+    start = int(first)
+    if last and int(last) < start:
+        return None  # Invalid range
+    if start >= size:
+        return False
+    return start, min(int(last) + 1, size) if last else size
+
+
+class Server(object):
+    """Asyncio HTTP server for encrypted DLS1 files.
+
+    Files of the root directory are served with sendfile, supporting
+    single byte ranges and keep-alive connections. Plain RSBJ archives
+    are validated and encrypted once into the cache directory by prepare().
+    """
+
+    def __init__(self, root, name="WIFI", cache=None, timeout=15.0):
+        self.root = os.path.abspath(root)
+        self.cache = os.path.abspath(
+            cache if cache else os.path.join(self.root, ".encrypted")
+        )
+        self.name = name
+        self.timeout = timeout
+
+    def prepare(self):
+        """Encrypt plain RSBJ archives of root into the cache directory.
+
+        Return a list of (file name, error) of the archives skipped, whose
+        previously encrypted copy is removed.
+        """
+        if not os.path.isdir(self.cache):
+            os.makedirs(self.cache)
+        key, iv = KEY_IV_MAP[self.name]
+        errors = []
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if not os.path.isfile(path):
+                continue
+            cached = os.path.join(self.cache, name)
+            with open(path, "rb") as f:
+                if f.read(4) != b"RSBJ":
+                    continue
+                report = validate(f, deep=True)
+                f.seek(0)
+                try:
+                    if report["errors"]:
+                        raise ValueError("; ".join(report["errors"]))
+                    with atomic_open(cached) as dst:
+                        encrypt_file(f, dst, key, iv)
+                except ValueError as e:
+                    errors.append((name, str(e)))
+                    if os.path.exists(cached):
+                        os.remove(cached)
+        return errors
+
+    def resolve(self, target):
+        """Return the file served for target or None.
+
+        Plain archives of root are never served, only their encrypted copy
+        from the cache (missing if prepare() rejected them).
+        """
+        name = unquote(target.split("?", 1)[0]).lstrip("/")
+        if not name or "/" in name or "\\" in name or name.startswith("."):
+            return None
+        path = os.path.join(self.cache, name)
+        if os.path.isfile(path):
+            return path
+        path = os.path.join(self.root, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            if f.read(4) == b"RSBJ":
+                return None
+        return path
+
+    async def respond(self, writer, status, headers=(), keep_alive=False):
+        lines = ["HTTP/1.1 {} {}".format(status, REASONS[status])]
+        lines.extend("{}: {}".format(k, v) for k, v in headers)
+        lines.append("Connection: {}".format(
+            "keep-alive" if keep_alive else "close"
+        ))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def serve(self, writer, method, target, headers, keep_alive):
+        if method not in ("GET", "HEAD"):
+            await self.respond(writer, 405, [
+                ("Allow", "GET, HEAD"), ("Content-Length", 0)
+            ], keep_alive)
+            return
+        path = self.resolve(target)
+        if path is None:
+            await self.respond(
+                writer, 404, [("Content-Length", 0)], keep_alive
+            )
+            return
+
+        stat = os.stat(path)
+        start, end = 0, stat.st_size
+        status = 200
+        response = [
+            ("Content-Type", "application/octet-stream"),
+            ("Accept-Ranges", "bytes"),
+            ("Last-Modified",
+             email.utils.formatdate(stat.st_mtime, usegmt=True)),
+        ]
+        if "range" in headers:
+            byte_range = parse_range(headers["range"], stat.st_size)
+            if byte_range is False:
+                await self.respond(writer, 416, [
+                    ("Content-Range", "bytes */{}".format(stat.st_size)),
+                    ("Content-Length", 0)
+                ], keep_alive)
+                return
+            if byte_range is not None:
+                status = 206
+                start, end = byte_range
+                response.append(("Content-Range", "bytes {}-{}/{}".format(
+                    start, end - 1, stat.st_size
+                )))
+        response.append(("Content-Length", end - start))
+        await self.respond(writer, status, response, keep_alive)
+        if method == "GET" and end > start:
+            with open(path, "rb") as f:
+                await asyncio.get_running_loop().sendfile(
+                    writer.transport, f, start, end - start
+                )
+
+    async def handle(self, reader, writer):
+        r"""Handle a client connection.
+
+        Request bodies aren't read, so requests with a body close the
+        connection instead of having it parsed as the next request.
+
+        >>> import shutil, tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> with open(os.path.join(root, "plain.txt"), "wb") as f:
+        ...     _ = f.write(b"plain")
+        >>> async def exchange(request):
+        ...     server = await Server(root).start(port=0)
+        ...     port = server.sockets[0].getsockname()[1]
+        ...     reader, writer = await asyncio.open_connection(
+        ...         "127.0.0.1", port
+        ...     )
+        ...     writer.write(request)
+        ...     response = await reader.read()
+        ...     writer.close()
+        ...     server.close()
+        ...     await server.wait_closed()
+        ...     return [int(status) for status in re.findall(
+        ...         rb"HTTP/1\.1 (\d+) ", response
+        ...     )]
+        >>> asyncio.run(exchange(
+        ...     b"GET /plain.txt HTTP/1.1\r\n\r\n"
+        ...     b"POST /a.bin HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+        ...     b"GET /plain.txt HTTP/1.1\r\n\r\n"
+        ... ))
+        [200, 405]
+        >>> asyncio.run(exchange(
+        ...     b"POST /a.bin HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+        ...     b"5\r\nhello\r\n0\r\n\r\n"
+        ...     b"GET /plain.txt HTTP/1.1\r\n\r\n"
+        ... ))
+        [405]
+        >>> shutil.rmtree(root)
+        """
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.timeout
+                    )
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = request.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    await self.respond(writer, 400, [("Content-Length", 0)])
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = connection != "close"
+                else:
+                    keep_alive = connection == "keep-alive"
+                if "transfer-encoding" in headers or \
+                        headers.get("content-length", "0") != "0":
+                    keep_alive = False  # Unread body
+                await self.serve(writer, method, target, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8080, backlog=4096):
+        """Start serving, return the asyncio server."""
+        return await asyncio.start_server(
+            self.handle, host, port, backlog=backlog
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root",
+                        type=str,
+                        help="directory of the files to serve")
+    parser.add_argument("--host",
+                        type=str, default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("-p", "--port",
+                        type=int, default=8080,
+                        help="port to listen on")
+    parser.add_argument("-s", "--sd",
+                        action="store_true",
+                        help="use SD key to encrypt plain archives")
+    parser.add_argument("-c", "--cache",
+                        type=str,
+                        help="encrypted archives directory")
+
+    args = parser.parse_args()
+    server = Server(args.root, "SD" if args.sd else "WIFI", args.cache)
+    for name, error in server.prepare():
+        print("{}: {}".format(name, error))
+
+    async def main():
+        s = await server.start(args.host, args.port)
+        async with s:
+            await s.serve_forever()
+
+    asyncio.run(main())
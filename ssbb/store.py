@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB section store module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii
+import glob
+import hashlib
+import json
+import mmap
+import os
+
+from collections import Counter, namedtuple
+
+from archive import Archive, LazyArchive
+from batch import atomic_open, expand
+
+
+class Store(object):
+    """Content-addressed store of Archive sections.
+
+    Sections are stored once under root/objects, keyed by their CRC32 and
+    size, the SHA-256 digest telling apart colliding sections. Archives are
+    saved as manifests listing their section references.
+
+    Example:
+    root/objects/07/073994cd_1905c_<sha256>
+    root/manifests/s20130702_1.json
+    """
+
+    Ref = namedtuple("StoreRef", ["crc32", "size", "digest"])
+
+    def __init__(self, root):
+        """Open or create the store in root directory."""
+        self.root = root
+        for name in ("objects", "manifests"):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _path(self, ref):
+        name = "{:08x}_{:x}_{}".format(ref.crc32, ref.size, ref.digest)
+        return os.path.join(self.root, "objects", name[:2], name)
+
+    def find(self, crc32, size):
+        """Return the references of stored sections with crc32 and size."""
+        pattern = os.path.join(
+            self.root, "objects", "{:08x}".format(crc32)[:2],
+            "{:08x}_{:x}_*".format(crc32, size)
+        )
+        return sorted(
+            Store.Ref(crc32, size, os.path.basename(path).split("_")[2])
+            for path in glob.glob(pattern)
+        )
+
+    def put(self, section):
+        """Store an Archive section if needed, return its reference."""
+        if not isinstance(section, Archive.Section):
+            archive = Archive()
+            archive.add_section(section)
+            section = archive[0]
+        elif section.crc32 is None:  # Deferred CRC32
+            section = Archive.Section(
+                section.data, section.size,
+                binascii.crc32(section.data) & 0xFFFFFFFF
+            )
+        ref = Store.Ref(
+            section.crc32, section.size,
+            hashlib.sha256(section.data).hexdigest()
+        )
+        path = self._path(ref)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:  # Already exists, maybe created by another thread
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+            with atomic_open(path) as f:
+                f.write(section.data)
+        return ref
+
+    def get(self, ref):
+        """Return an Archive section backed by a read-only mmap."""
+        if not ref.size:
+            return Archive.Section(b"", 0, ref.crc32)
+        with open(self._path(ref), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Archive.Section(data, ref.size, ref.crc32)
+
+    def put_archive(self, archive):
+        """Store Archive sections, return their references."""
+        return [self.put(section) for section in archive]
+
+    def get_archive(self, refs):
+        """Return an Archive made of stored sections.
+
+        Section CRCs come from the references and their data is mapped
+        from the store, so packing it only computes the section table.
+        """
+        archive = Archive()
+        archive.add_sections(self.get(ref) for ref in refs)
+        return archive
+
+    def save(self, name, archive):
+        """Store Archive sections and its manifest, return the references."""
+        refs = self.put_archive(archive)
+        path = os.path.join(self.root, "manifests", name + ".json")
+        with atomic_open(path, "w") as f:
+            json.dump({"sections": [list(ref) for ref in refs]}, f)
+        return refs
+
+    def load(self, name):
+        """Return the Archive saved under name."""
+        path = os.path.join(self.root, "manifests", name + ".json")
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        return self.get_archive(
+            Store.Ref(*ref) for ref in manifest["sections"]
+        )
+
+    def names(self):
+        """Return the names of saved archives."""
+        return sorted(
+            os.path.splitext(os.path.basename(path))[0]
+            for path in glob.glob(
+                os.path.join(self.root, "manifests", "*.json")
+            )
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store",
+                        type=str,
+                        help="store directory")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-a", "--add",
+                       type=str, nargs="+", metavar="FILE",
+                       help="add archive files, directories or globs")
+    group.add_argument("-x", "--extract",
+                       type=str, nargs="+", metavar="NAME",
+                       help="rebuild archive files from the store")
+    group.add_argument("-l", "--list",
+                       action="store_true",
+                       help="list stored archives")
+    parser.add_argument("--pattern",
+                        type=str, default="*",
+                        help="files to add in directories")
+    parser.add_argument("-d", "--dest",
+                        type=str, default=".",
+                        help="destination directory of extracted archives")
+
+    args = parser.parse_args()
+    store = Store(args.store)
+    if args.add:
+        paths = expand(args.add, args.pattern)
+        names = Counter(os.path.basename(path) for path in paths)
+        duplicates = sorted(n for n, count in names.items() if count > 1)
+        if duplicates:
+            parser.error("archives sharing a manifest name: {}".format(
+                ", ".join(duplicates)
+            ))
+        for path in paths:
+            archive = LazyArchive.open(path)
+            try:
+                store.save(os.path.basename(path), archive)
+            finally:
+                archive.close()
+    if args.extract:
+        for name in args.extract:
+            with atomic_open(os.path.join(args.dest, name)) as f:
+                store.load(name).write(f)
+    if args.list:
+        for name in store.names():
+            print(name)
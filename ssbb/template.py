@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SSBB setting template module.
+
+    SSBB DLS1 Project
+    Copyright (C) 2018  Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii
+import struct
+
+from archive import Archive
+from dls1 import Setting
+
+CRC32_OFFSET = 0x10
+CRC32_END = 0x14
+
+# Patchable Setting fields: offset in the packed setting and layout
+FIELDS = {}
+_offset = 0x20
+for _name, _format in [
+    ("contribute", ">B"),
+    ("is_infinity_contribute", ">B"),
+    ("collection_lifetime", ">B"),
+    ("unknown_0x03", ">B"),
+    ("contribute_start", ">HBB"), ("contribute_end", ">HBB"),
+    ("watch_start", ">HBB"), ("watch_end", ">HBB"),
+    ("deliv_start", ">HBB"), ("deliv_end", ">HBB"),
+    ("enable_upload_character", ">Q"),
+    ("enable_upload_stage", ">Q"),
+]:
+    FIELDS[_name] = (_offset, struct.Struct(_format))
+    _offset += FIELDS[_name][1].size
+assert _offset == Setting.LAYOUT.size
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def _shift_operator(length):
+    """Return the GF(2) matrix updating a CRC32 with length zero bytes.
+
+    Port of zlib crc32_combine() operator, without the conditioning:
+    crc32(A + B) is _gf2_times(_shift_operator(len(B)), crc32(A)) ^ crc32(B).
+    """
+    operator = [1 << n for n in range(32)]  # Identity
+    if length <= 0:
+        return operator
+    odd = [0xEDB88320] + [1 << n for n in range(31)]  # One zero bit
+    even = _gf2_square(odd)  # Two zero bits
+    odd = _gf2_square(even)  # Four zero bits
+    while True:
+        even = _gf2_square(odd)
+        if length & 1:
+            operator = [_gf2_times(even, column) for column in operator]
+        length >>= 1
+        if not length:
+            break
+        odd = _gf2_square(even)
+        if length & 1:
+            operator = [_gf2_times(odd, column) for column in operator]
+        length >>= 1
+        if not length:
+            break
+    return operator
+
+
+def crc32_combine(crc1, crc2, length2):
+    """Return the CRC32 of A + B from crc1 of A, crc2 of B and len(B)."""
+    return _gf2_times(_shift_operator(length2), crc1) ^ crc2
+
+
+class Shift(object):
+    """Precomputed CRC32 shift by a fixed number of bytes.
+
+    The shift is linear, so it is tabulated once for each CRC byte and
+    applied with four lookups.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        operator = _shift_operator(length)
+        self.tables = [
+            [_gf2_times(operator, value << (8 * i)) for value in range(0x100)]
+            for i in range(4)
+        ]
+
+    def __call__(self, crc):
+        t0, t1, t2, t3 = self.tables
+        return t0[crc & 0xFF] ^ t1[(crc >> 8) & 0xFF] ^ \
+            t2[(crc >> 16) & 0xFF] ^ t3[crc >> 24]
+
+    def combine(self, crc1, crc2):
+        """Return crc32_combine(crc1, crc2, self.length)."""
+        return self(crc1) ^ crc2
+
+
+class Template(object):
+    """Packed Setting whose fields are patched into copies.
+
+    The template is packed once. Only the span covering the patchable
+    fields is hashed for each variant: the CRC32 of the unchanged prefix
+    is resumed and the unchanged suffix CRC32 is combined with a
+    precomputed Shift. The Archive section CRC32 (which covers the
+    setting CRC32) is derived the same way, so neither the setting nor
+    its archive ever hashes the whole buffer again.
+    """
+
+    def __init__(self, setting, fields):
+        """Pack setting as a template for variants patching fields.
+
+        fields are FIELDS names and/or "spectator_misc" (patched with data
+        of the same size).
+        """
+        self.data = bytes(setting.pack())
+        self.fields = {}
+        spans = []
+        for name in fields:
+            if name == "spectator_misc":
+                offset = Setting.LAYOUT.size
+                self.fields[name] = (offset, None)
+                spans.append((offset, len(self.data)))
+            elif name in FIELDS:
+                offset, layout = self.fields[name] = FIELDS[name]
+                spans.append((offset, offset + layout.size))
+            else:
+                raise ValueError("unpatchable setting field: {}".format(name))
+        if not spans:
+            raise ValueError("no patchable field")
+        self.start = min(start for start, _ in spans)
+        self.end = max(end for _, end in spans)
+
+        data = bytearray(self.data)
+        data[CRC32_OFFSET:CRC32_END] = Setting.CRC32_PLACEHOLDER
+        # Setting CRC32: prefix + span + suffix
+        self._prefix_crc32 = binascii.crc32(data[:self.start])
+        self._suffix_crc32 = binascii.crc32(data[self.end:]) & 0xFFFFFFFF
+        self._suffix = Shift(len(data) - self.end)
+        # Section CRC32: data[:CRC32_END] + rest (data[CRC32_END:])
+        self._rest_crc32 = binascii.crc32(data[CRC32_END:self.start])
+        self._rest = Shift(len(data) - CRC32_END)
+
+    def patch(self, data, **values):
+        """Write field values into a copy of the template data."""
+        for name, value in values.items():
+            try:
+                offset, layout = self.fields[name]
+            except KeyError:
+                raise ValueError("field not in template: {}".format(name))
+            if layout is None:
+                if len(value) != len(data) - offset:
+                    raise ValueError("spectator_misc size mismatch")
+                data[offset:] = value
+            elif isinstance(value, tuple):
+                layout.pack_into(data, offset, *value)
+            else:
+                layout.pack_into(data, offset, value)
+
+    def variant(self, **values):
+        """Return an Archive section of the template with patched fields.
+
+        Its data is the packed setting, with its setting CRC32 computed.
+        """
+        data = bytearray(self.data)
+        self.patch(data, **values)
+        span = data[self.start:self.end]
+        crc32 = self._suffix.combine(
+            binascii.crc32(span, self._prefix_crc32) & 0xFFFFFFFF,
+            self._suffix_crc32
+        )
+        Setting.CRC32.pack_into(data, CRC32_OFFSET, crc32)
+
+        rest_crc32 = self._suffix.combine(
+            binascii.crc32(span, self._rest_crc32) & 0xFFFFFFFF,
+            self._suffix_crc32
+        )
+        section_crc32 = self._rest.combine(
+            binascii.crc32(data[:CRC32_END]) & 0xFFFFFFFF, rest_crc32
+        )
+        return Archive.Section(data, len(data), section_crc32)
+
+    def variants(self, patches):
+        """Yield the variant() section of each patch dict."""
+        for values in patches:
+            yield self.variant(**values)
+
+
+def archives(sections, count=1, padding=16):
+    """Yield packed Archives of count variant sections each."""
+    archive = Archive()
+    for section in sections:
+        archive.add_section(section)
+        if len(archive) == count:
+            yield archive.pack(padding)
+            archive = Archive()
+    if len(archive):
+        yield archive.pack(padding)